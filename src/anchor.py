@@ -0,0 +1,189 @@
+"""
+anchor.py
+    [class] Circle: one detected circle in pixel coordinates
+    [class] AnchorResult: anchors found in a frame
+    [class] AnchorDetector: find the anchors on the 8-bit temperature matrix and track them across frames
+"""
+import copy
+import logging
+from collections import namedtuple
+from math import ceil
+
+import cv2
+
+from .color import LUT_SIZE, Normalization
+from .color import ColorTransformation as c_trans
+
+LOGGER = logging.getLogger(__name__)
+
+Circle = namedtuple('Circle', ['x', 'y', 'radius'])
+
+# circles: tuple of Circle, accepted: at least min_circles, tracked: found around the previous anchors
+AnchorResult = namedtuple('AnchorResult', ['path', 'circles', 'accepted', 'tracked'])
+
+class AnchorDetector(object):
+    """
+    Find the anchors by Hough Circles on the normalized 8-bit temperature matrix, no rgb round trip
+    1. the anchors of the last full search (key frame) are matched in a small ROI
+       around their last position, the key frame is kept so the slow drift is not lost by rounding
+       the lost anchors are dropped, the one near the border is matched in the clipped ROI
+    2. a full search only if less than min_circles anchors are matched, a cheap downscaled pass first
+       rejects the frame which cannot have min_circles circles, then Hough Circles at full resolution
+
+    the detector keeps the anchors of the last frame, use one detector per sequence of frames
+
+    [Input]
+        min_circles: number of circles to accept the frame
+        min_dist, param1, param2, min_radius, max_radius: cv2.HoughCircles setting at full resolution
+        downscale: scale of the pre-pass, 1 to skip the downscaling
+        margin: pixels around the anchor searched when tracking
+        track_threshold: min normalized correlation of the anchor with the previous frame
+        normalization: Normalization to 8-bit, default to per-frame range
+    """
+    def __init__(self, min_circles=4, min_dist=10, param1=100, param2=22, min_radius=0, max_radius=25,
+                 downscale=0.5, margin=6, track_threshold=0.7, normalization=None):
+        super().__init__()
+        self.min_circles = min_circles
+        self.min_dist = min_dist
+        self.param1 = param1
+        self.param2 = param2
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.downscale = downscale
+        self.margin = margin
+        self.track_threshold = track_threshold
+        self.normalization = normalization or Normalization()
+        self._previous = ()
+        self._key_circles = ()
+        self._key_gray = None
+
+    def __repr__(self):
+        return ('{}(min_circles={}, min_dist={}, param1={}, param2={}, min_radius={}, max_radius={}, '
+                'downscale={}, margin={}, track_threshold={}, normalization={})').format(
+            self.__class__.__name__, self.min_circles, self.min_dist, self.param1, self.param2,
+            self.min_radius, self.max_radius, self.downscale, self.margin, self.track_threshold,
+            self.normalization)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_previous'], state['_key_circles'], state['_key_gray'] = (), (), None
+        return state
+
+    def fresh(self):
+        """
+        [Output] AnchorDetector of the same setting without tracked anchors
+        """
+        detector = copy.copy(self)
+        detector._previous, detector._key_circles, detector._key_gray = (), (), None
+        return detector
+
+    def to_8bit(self, mat):
+        """
+        [Output] (ndarray) uint8 normalized temperature in the same shape of mat
+        """
+        heat_min, heat_max = self.normalization.range_of(mat)
+        scale = self.normalization.scale(LUT_SIZE-1) if self.normalization.is_fixed else None
+        return c_trans.quantize_transformation_array(mat, heat_min, heat_max, scale=scale)
+
+    def hough(self, gray, scale=1.0):
+        """
+        [Input] uint8 image, scale: of the image to the full resolution
+        [Output] (list) Circle in the coordinates of the full resolution
+        """
+        circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1, max(1, self.min_dist*scale),
+                                   param1=self.param1,
+                                   param2=max(1, int(round(self.param2*scale))),
+                                   minRadius=int(self.min_radius*scale),
+                                   maxRadius=max(1, int(ceil(self.max_radius*scale))))
+        if circles is None:
+            return []
+        return [Circle(float(x)/scale, float(y)/scale, float(r)/scale) for x, y, r in circles[0]]
+
+    def search(self, gray):
+        """
+        Full search, the downscaled pass rejects the frame early
+        [Output] (list) Circle
+        """
+        if self.downscale < 1:
+            small = cv2.resize(gray, None, fx=self.downscale, fy=self.downscale,
+                               interpolation=cv2.INTER_AREA)
+            candidates = self.hough(small, scale=self.downscale)
+            if len(candidates) < self.min_circles:
+                return candidates
+        return self.hough(gray)
+
+    @staticmethod
+    def _window(center, half, size):
+        """[start, stop) of center +- half clipped to [0, size)"""
+        return max(center - half, 0), min(center + half + 1, size)
+
+    def match(self, gray, key_circle, circle):
+        """
+        Match the anchor of the key frame in the ROI around its last position
+        the template and the ROI are clipped at the frame border, so the anchor near the edge is kept
+        [Input] gray: current frame, key_circle: in the key frame, circle: last position
+        [Output] Circle moved to the best match, None if lost
+        """
+        half = int(ceil(key_circle.radius))
+        kx, ky = int(round(key_circle.x)), int(round(key_circle.y))
+        x, y = int(round(circle.x)), int(round(circle.y))
+        row, col = gray.shape
+        tx0, tx1 = self._window(kx, half, col)
+        ty0, ty1 = self._window(ky, half, row)
+        rx0, rx1 = self._window(x, half + self.margin, col)
+        ry0, ry1 = self._window(y, half + self.margin, row)
+        # too little of the anchor left in the frame, or the ROI cannot hold the template
+        if tx1 - tx0 < 2 or ty1 - ty0 < 2 or rx1 - rx0 < tx1 - tx0 or ry1 - ry0 < ty1 - ty0:
+            return
+
+        template = self._key_gray[ty0:ty1, tx0:tx1]
+        score = cv2.matchTemplate(gray[ry0:ry1, rx0:rx1], template, cv2.TM_CCOEFF_NORMED)
+        _, max_score, _, (dx, dy) = cv2.minMaxLoc(score)
+        if not max_score >= self.track_threshold:
+            return
+        # shift of the best match from the template in the key frame
+        return Circle(key_circle.x + rx0 + dx - tx0, key_circle.y + ry0 + dy - ty0, key_circle.radius)
+
+    def track(self, gray):
+        """
+        [Output] (list) of (key circle, Circle) matched around the last anchors, the lost ones are dropped
+        """
+        pairs = []
+        for key_circle, circle in zip(self._key_circles, self._previous):
+            circle = self.match(gray, key_circle, circle)
+            if circle is not None:
+                pairs.append((key_circle, circle))
+        return pairs
+
+    def detect(self, mat, path=None):
+        """
+        keep tracking while at least min_circles anchors are matched, otherwise full search
+        [Input] (ndarray) temperature matrix, path: recorded in the result
+        [Output] AnchorResult
+        """
+        gray = self.to_8bit(mat)
+        pairs = self.track(gray) if self._previous else []
+        tracked = len(pairs) >= self.min_circles
+        circles = [circle for _, circle in pairs] if tracked else self.search(gray)
+
+        accepted = len(circles) >= self.min_circles
+        self._previous = tuple(circles) if accepted else ()
+        if tracked:
+            # the key frame stays, only the anchors still matched are followed
+            self._key_circles = tuple(key_circle for key_circle, _ in pairs)
+        else:
+            self._key_circles = self._previous
+            self._key_gray = gray if accepted else None
+        LOGGER.debug('{}: circle_count = {} tracked = {}'.format(path, len(circles), tracked))
+        return AnchorResult(path, tuple(circles), accepted, tracked)
+
+    @staticmethod
+    def draw(rgb, circles):
+        """
+        Draw the circles and the centers on the image in place
+        """
+        for circle in circles:
+            center = (int(round(circle[0])), int(round(circle[1])))
+            cv2.circle(rgb, center, int(round(circle[2])), (0, 0, 0), 1)
+            cv2.circle(rgb, center, 2, (255, 255, 255), 1)
+        return rgb
@@ -5,13 +5,16 @@ import time
 import tkinter
 from tkinter import filedialog, ttk
 
+from .job import ConversionJob
 from .msg_box import MessageBox
 from .tkcomponent import TkFrame
 from .ttkcomponent import TTKStyle, init_css
-from .wrapper import cf_convert_to_grayscale, cf_convert_to_rgb
+from .wrapper import cf_iter_convert
 
 LOGGER = logging.getLogger(__name__)
 COLORMAP = [('RGB', 'rgb'), ('Gray', 'gray')]
+# interval in ms to drain the progress events of the background conversion
+DRAIN_INTERVAL = 200
 
 
 class ThermalViewer(object):
@@ -117,6 +120,8 @@ class ThermalViewer(object):
         self.btn_load.grid(row=0, column=0, sticky='e')
         self.btn_ok = ttk.Button(self.frame_load, text=u'開始轉換', style='H5.TButton')
         self.btn_ok.grid(row=0, column=1, sticky='e')
+        self.btn_cancel = ttk.Button(self.frame_load, text=u'取消', style='H5.TButton', state=tkinter.DISABLED)
+        self.btn_cancel.grid(row=0, column=2, sticky='e')
 
     def _init_widget_state(self):
         TTKStyle('H2.TLabel', font=('', 24, 'bold'))
@@ -132,8 +137,6 @@ class ThermalViewer(object):
 
     def _sync_state(self):
         self.label_state.config(text='Total file: {}/{}'.format(self.done_count, self.total_count))
-        if self.root is not None and 'normal' == self.root.state():
-            self.label_state.after(10, self._sync_state)
 
     def _open_filedialog(self):
         self.open_directory = filedialog.askdirectory(
@@ -162,19 +165,23 @@ class ThermalViewer(object):
         self.root.mainloop()
 
 class ThermalAction(ThermalViewer):
+    """
+    The conversion runs in ConversionJob, the Tk thread only drains its events every DRAIN_INTERVAL ms
+    while the job is running, the progress comes from the saved frames instead of listing the folder
+    """
     def __init__(self, open_filenames=None, save_directory=None, multiprocess=True):
         """"self.save_directory is useless"""
         super().__init__(open_filenames, save_directory)
         self.convert_mode = None
         self.flag_multiprocess = multiprocess
+        self.job = None
+        self.last_event = None
         self.btn_load.config(command=self._choose_load_path)
         self.btn_ok.config(command=self.run)
-        self._sync_generate_save_path()
+        self.btn_cancel.config(command=self.cancel)
+        self.val_colormap.trace_add('write', lambda *args: self._sync_generate_save_path())
 
     def _sync_state(self):
-        if self.save_directory and os.path.exists(self.save_directory):
-            self.done_count = len(os.listdir(self.save_directory))
-
         msg = ''
         if self.convert_mode is None:
             msg = u'N/A'
@@ -182,11 +189,21 @@ class ThermalAction(ThermalViewer):
             msg = u'轉換中'
         elif self.convert_mode == 'done':
             msg = u'已轉換完成'
-        self.label_state.config(text=u'共 {} 份文件 - {}'.format(self.total_count, msg))
-
-        if self.root is not None and 'normal' == self.root.state():
-            self.root.update()
-            self.label_state.after(10, self._sync_state)
+        elif self.convert_mode == 'cancelled':
+            msg = u'已取消'
+        elif self.convert_mode == 'error':
+            msg = u'轉換失敗'
+        text = u'共 {} 份文件 - {}'.format(self.total_count, msg)
+
+        if self.last_event is not None:
+            rate, eta = ConversionJob.throughput(self.last_event)
+            text += u'\n{}/{} ({:.1f} 張/秒'.format(self.done_count, self.total_count, rate)
+            if self.convert_mode == 'convert' and eta is not None:
+                text += u', 剩餘 {:.0f} 秒'.format(eta)
+            text += u')'
+            if self.last_event.failed:
+                text += u' 失敗 {}'.format(self.last_event.failed)
+        self.label_state.config(text=text)
 
     def _sync_generate_save_path(self):
         if self.open_directory and self.val_colormap.get():
@@ -196,12 +213,10 @@ class ThermalAction(ThermalViewer):
             self.save_directory = os.sep.join(save_path)
             self.label_save_path.config(text=self.save_directory)
 
-        if self.root and 'normal' == self.root.state():
-            self.root.after(10, self._sync_generate_save_path)
-
     def _choose_load_path(self):
         self._enable_all_checkbtn()
         self._open_filedialog()
+        self._sync_generate_save_path()
 
     def _enable_all_checkbtn(self):
         for radiobtn in self.radiobtn:
@@ -215,25 +230,53 @@ class ThermalAction(ThermalViewer):
         self.root.mainloop()
 
     def run(self):
-        if self.open_filenames:
+        if not getattr(self, 'open_filenames', None) or (self.job is not None and self.job.is_running):
+            return
+        if not hasattr(self, 'label_state'):
             self._init_frame_footer()
-            self._disable_all_checkbtn()
-
-            if self.val_colormap.get() == 'rgb':
-                self.convert_mode = 'convert'
-                self._sync_state()
-                self.root.update()
-                mod_savedir = '{}_{}'.format(self.open_directory.split(os.sep)[-1], self.val_colormap.get())
-                cf_convert_to_rgb(self.open_directory, (-2, mod_savedir))
-                self.convert_mode = 'done'
-                # self.root.destroy()
-            elif self.val_colormap.get() == 'gray':
-                self.convert_mode = 'convert'
-                self._sync_state()
-                self.root.update()
-                mod_savedir = '{}_{}'.format(self.open_directory.split(os.sep)[-1], self.val_colormap.get())
-                cf_convert_to_grayscale(self.open_directory, (-2, mod_savedir))
-                self.convert_mode = 'done'
-                Mbox = MessageBox()
-                Mbox.info(string=u'已完成, 按確認關閉視窗', parent=self.root)
-                # self.root.destroy()
+        self._disable_all_checkbtn()
+        self.btn_ok.config(state=tkinter.DISABLED)
+        self.btn_load.config(state=tkinter.DISABLED)
+        self.btn_cancel.config(state=tkinter.NORMAL)
+
+        mode = self.val_colormap.get()
+        mod_savedir = '{}_{}'.format(self.open_directory.split(os.sep)[-1], mode)
+        self.convert_mode = 'convert'
+        self.done_count = 0
+        self.last_event = None
+        self._sync_state()
+        self.job = ConversionJob(
+            lambda: cf_iter_convert(self.open_directory, mode, (-2, mod_savedir)),
+            total=self.total_count).start()
+        self.root.after(DRAIN_INTERVAL, self._drain_events)
+
+    def cancel(self):
+        if self.job is not None:
+            self.btn_cancel.config(state=tkinter.DISABLED)
+            self.job.cancel()
+
+    def _drain_events(self):
+        """apply the events of the job, reschedule until the job is finished"""
+        finished = False
+        for event in self.job.poll():
+            self.last_event = event
+            self.done_count = event.done
+            if event.kind != 'progress':
+                finished = True
+                self.convert_mode = event.kind
+                if event.kind == 'error':
+                    LOGGER.error('Conversion failed: {}'.format(event.message))
+        if self.last_event is not None:
+            self._sync_state()
+
+        if not finished:
+            self.root.after(DRAIN_INTERVAL, self._drain_events)
+            return
+
+        self.btn_cancel.config(state=tkinter.DISABLED)
+        self.btn_ok.config(state=tkinter.NORMAL)
+        self.btn_load.config(state=tkinter.NORMAL)
+        self._enable_all_checkbtn()
+        if self.convert_mode == 'done' and self.val_colormap.get() == 'gray':
+            Mbox = MessageBox()
+            Mbox.info(string=u'已完成, 按確認關閉視窗', parent=self.root)
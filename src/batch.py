@@ -0,0 +1,272 @@
+"""
+batch.py
+    [func] find_frame_folders: every folder of .txt frames under the input roots
+    [class] OutputLayout: saved path of each frame, mirrored under a directory or by replacing a path component
+    [class] BatchConverter: convert the frames of all folders through one shared ConverterExecutor
+    [func] main: headless command-line entry, no display needed
+
+    python -m src.batch ROOT [ROOT ...] --mode rgb --out OUT_DIR [--workers 8] [--backend process]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from functools import partial
+from itertools import chain
+from os.path import abspath, basename, dirname, isdir, join, normpath, relpath, splitext
+
+import cv2
+
+from . import metrics
+from .anchor import AnchorDetector
+from .color import Normalization, list_colormaps
+from .convert import ANCHOR_BATCH_SIZE, BATCH_SIZE, ConcurrentConverter, Converter, FrameStatus
+from .executor import BACKENDS, ConverterExecutor
+from .order import natural_key
+from .pipeline import StagedPipeline
+
+LOGGER = logging.getLogger(__name__)
+MODES = ('rgb', 'gray', 'hough', 'max-diff')
+FRAME_EXT = '.txt'
+
+def find_frame_folders(roots, recursive=True):
+    """
+    [Input] list of root folder, recursive: also the sub folders
+    [Output] (list) of (root, folder, frame paths in the order of recording), the folder without frames is skipped
+    """
+    folders = []
+    for root in roots:
+        if not isdir(root):
+            raise ValueError('{} is not a folder'.format(root))
+        walk = os.walk(root) if recursive else [(root, [], os.listdir(root))]
+        for folder, sub_folders, files in walk:
+            sub_folders.sort()
+            paths = sorted((join(folder, f) for f in files if f.endswith(FRAME_EXT)), key=natural_key)
+            if paths:
+                folders.append((root, folder, paths))
+    return folders
+
+class OutputLayout(object):
+    """
+    Saved path of each frame
+        out_dir: <out_dir>/<name of root>/<folder relative to root>/<frame>.png
+        replace: (index, name) replace the path component as wrapper.construct_png_path
+    [Input] folders: from find_frame_folders
+    """
+    def __init__(self, folders, out_dir=None, replace=None, ext='.png'):
+        super().__init__()
+        if (out_dir is None) == (replace is None):
+            raise ValueError('either out_dir or replace should be given')
+        self.out_dir = out_dir
+        self.replace = replace
+        self.ext = ext
+        self._destinations = {}
+        if out_dir is not None:
+            for root, folder, _ in folders:
+                root = abspath(root)
+                self._destinations[abspath(folder)] = normpath(
+                    join(out_dir, basename(root), relpath(abspath(folder), root)))
+
+    def __repr__(self):
+        return '{}(out_dir={}, replace={}, ext={})'.format(
+            self.__class__.__name__, self.out_dir, self.replace, self.ext)
+
+    def __call__(self, path):
+        """
+        [Input] frame path
+        [Output] saved path
+        """
+        if self.replace is not None:
+            index, name = self.replace
+            parts = path.split(os.sep)
+            parts[-1] = splitext(parts[-1])[0] + self.ext
+            parts[index] = str(name)
+            return os.sep.join(parts)
+        return join(self._destinations[abspath(dirname(path))], splitext(basename(path))[0] + self.ext)
+
+def folder_heap(keyed_chunk, reader=None):
+    """
+    [Input] (folder, start, paths) chunk of one folder
+    [Output] (folder, heap of the max temperature difference)
+    """
+    folder, start, paths = keyed_chunk
+    return folder, Converter.heap_by_temperature_difference(paths, 1, reader, start)
+
+class BatchConverter(object):
+    """
+    Convert many folders as one job, the chunks of all folders share one pool
+    a worker takes the next chunk of any folder once it is free, so a small folder never
+    leaves the cores idle while waiting for the other folders
+    a chunk never crosses the folder, the anchors are only tracked within a folder
+
+    [Input]
+        folders: from find_frame_folders
+        mode: 'rgb', 'gray', 'hough' or 'max-diff'
+        cb_save: callback from source path to saved path, e.g. OutputLayout
+        executor: shared ConverterExecutor
+        colormap, normalization: see ConcurrentConverter.cf_file_to_image
+        draw_circle, detector: see ConcurrentConverter.cf_file_to_rgb_by_hough_circle
+        batch_size: number of frames per task, default to BATCH_SIZE or ANCHOR_BATCH_SIZE of hough
+        io_workers: number of threads to read and write
+    """
+    def __init__(self, folders, mode, cb_save, executor, colormap=None, normalization=None,
+                 draw_circle=False, detector=None, batch_size=None, io_workers=4):
+        super().__init__()
+        if mode not in MODES:
+            raise ValueError('mode should be one of {}, got {}'.format(MODES, mode))
+        self.folders = folders
+        self.mode = mode
+        self.cb_save = cb_save
+        self.executor = executor
+        self.colormap = colormap
+        self.normalization = normalization
+        self.draw_circle = draw_circle
+        self.detector = detector
+        self.batch_size = batch_size or (ANCHOR_BATCH_SIZE if mode == 'hough' else BATCH_SIZE)
+        self.io_workers = io_workers
+
+    def __repr__(self):
+        return '{}(folders={}, mode={}, executor={}, batch_size={})'.format(
+            self.__class__.__name__, len(self.folders), self.mode, self.executor, self.batch_size)
+
+    def chunks(self):
+        """generator of the chunks of each folder in turn"""
+        for _, folder, paths in self.folders:
+            for start, chunk in ConcurrentConverter.iter_chunks(paths, self.batch_size):
+                yield folder, start, chunk
+
+    def iter_convert(self):
+        """
+        rgb, gray and hough through StagedPipeline
+        [Output] generator of FrameStatus in the order of folders and frames
+        """
+        if self.mode == 'hough':
+            compute = partial(Converter.raw_to_hough_images, draw_circle=self.draw_circle,
+                              detector=self.detector)
+        else:
+            compute = partial(Converter.raw_to_images, mode=self.mode, colormap=self.colormap,
+                              normalization=self.normalization)
+        pipeline = StagedPipeline(
+            read=Converter.read_raw, compute=compute,
+            write=partial(Converter.write_images, cb_save=self.cb_save, created=set()),
+            executor=self.executor, io_workers=self.io_workers)
+
+        for statuses in pipeline.run(chunk for _, _, chunk in self.chunks()):
+            for status in statuses:
+                yield status
+
+    def iter_max_difference(self):
+        """
+        max-diff, the chunks of all folders are scanned in the shared pool
+        then the frame of max temperature difference of each folder is saved
+        [Output] generator of FrameStatus of each folder
+        """
+        heaps = {folder: [] for _, folder, _ in self.folders}
+        for folder, heap in ConcurrentConverter.iter_bounded(
+                folder_heap, self.chunks(), executor=self.executor, ordered=False):
+            heaps[folder] = ConcurrentConverter.merge_heap_by_temperature_difference([heaps[folder], heap])
+
+        for _, folder, _ in self.folders:
+            path, heat_map = ConcurrentConverter.sorted_by_temperature_difference(heaps[folder])[0]
+            saved_path = self.cb_save(path)
+            LOGGER.info('{}: path={} temperature_diff={}'.format(
+                folder, path, heat_map.heat_max - heat_map.heat_min))
+            try:
+                ConcurrentConverter.make_save_dirs([saved_path])
+                rgb = heat_map.transform_to_rgb(colormap=self.colormap)
+                Converter.write_image(saved_path, cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+                metrics.count('frames_saved')
+                yield FrameStatus(path, saved_path, True, '')
+            except Exception as e:
+                LOGGER.exception('{}'.format(e))
+                metrics.count('frames_failed')
+                yield FrameStatus(path, saved_path, False, '{}'.format(e))
+
+    def run(self, progress_every=1000):
+        """
+        [Output] (dict) number of frames, saved, rejected and failed, seconds
+        """
+        frames = sum(len(paths) for _, _, paths in self.folders)
+        LOGGER.info('Start {} of {} frames'.format(self, frames))
+        start = time.perf_counter()
+        counts = Counter()
+        statuses = self.iter_max_difference() if self.mode == 'max-diff' else self.iter_convert()
+        for i, status in enumerate(statuses, 1):
+            if status.saved:
+                counts['saved'] += 1
+            elif status.saved_path is None:
+                counts['rejected'] += 1
+            else:
+                counts['failed'] += 1
+                LOGGER.warning('{} is not saved: {}'.format(status.path, status.message))
+            if progress_every and i % progress_every == 0:
+                LOGGER.info('{} frames done, {:.1f} frames/s'.format(i, i / (time.perf_counter() - start)))
+
+        seconds = time.perf_counter() - start
+        summary = {'folders': len(self.folders), 'frames': frames, 'saved': counts['saved'],
+                   'rejected': counts['rejected'], 'failed': counts['failed'], 'seconds': seconds}
+        LOGGER.info('Done {}'.format(summary))
+        return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert the ThermaCAM frames of many folders without display')
+    parser.add_argument('roots', nargs='+', help='folders of .txt frames, sub folders are included')
+    parser.add_argument('--mode', default='rgb', choices=MODES)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--out', help='save under OUT/<root name>/<relative folder>/')
+    output.add_argument('--replace', nargs=2, metavar=('INDEX', 'NAME'),
+                        help='replace the path component at INDEX by NAME, e.g. -2 save')
+    parser.add_argument('--no-recursive', action='store_true', help='only the frames directly in the roots')
+    parser.add_argument('--workers', type=int, default=None, help='default to CPU count')
+    parser.add_argument('--backend', default='process', choices=BACKENDS)
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--io-workers', type=int, default=4)
+    parser.add_argument('--colormap', default=None, choices=list_colormaps())
+    heat_range = parser.add_mutually_exclusive_group()
+    heat_range.add_argument('--heat-range', nargs=2, type=float, metavar=('MIN', 'MAX'),
+                            help='fixed temperature range of rgb and gray')
+    heat_range.add_argument('--global-range', action='store_true',
+                            help='temperature range over all of the frames of all folders')
+    parser.add_argument('--draw-circle', action='store_true', help='draw the anchors in hough mode')
+    parser.add_argument('--track-anchors', action='store_true',
+                        help='hough mode on the 8-bit matrix with AnchorDetector instead of the rgb round trip')
+    parser.add_argument('--metrics', action='store_true', help='log the per-stage metrics at the end')
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.enable()
+    folders = find_frame_folders(args.roots, recursive=not args.no_recursive)
+    if not folders:
+        LOGGER.error('No {} frames under {}'.format(FRAME_EXT, args.roots))
+        return 1
+    replace = (int(args.replace[0]), args.replace[1]) if args.replace else None
+    layout = OutputLayout(folders, args.out, replace)
+
+    with ConverterExecutor(args.backend, args.workers) as executor:
+        normalization = None
+        if args.heat_range:
+            normalization = Normalization(*args.heat_range)
+        elif args.global_range:
+            normalization = ConcurrentConverter.cf_temperature_range(
+                list(chain.from_iterable(paths for _, _, paths in folders)), executor=executor)
+
+        converter = BatchConverter(
+            folders, args.mode, layout, executor, colormap=args.colormap, normalization=normalization,
+            draw_circle=args.draw_circle, detector=AnchorDetector() if args.track_anchors else None,
+            batch_size=args.batch_size, io_workers=args.io_workers)
+        summary = converter.run()
+
+    if args.metrics:
+        LOGGER.info('Metrics\n{}'.format(metrics.METRICS.format_summary()))
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(filename)12s:L%(lineno)3s [%(levelname)8s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        stream=sys.stderr
+    )
+    sys.exit(main())
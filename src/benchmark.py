@@ -0,0 +1,261 @@
+"""
+benchmark.py
+    [func] make_synthetic_frames: write ThermaCAM-format .txt frames shaped like test_file/*.txt
+    [class] Benchmark: time each stage and the end-to-end drivers, report as JSON
+
+    python -m src.benchmark [--frames 64] [--workers 1 2 4] [--backend process] [--metrics] [--out result.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from os.path import join
+
+import cv2
+import numpy as np
+
+from . import metrics
+from .anchor import AnchorDetector
+from .convert import ConcurrentConverter, Converter
+from .executor import ConverterExecutor
+from .heatmap import HeatMap
+from .reader import FRAME_SHAPE, ThermaCAMReader
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOGGER = logging.getLogger(__name__)
+STAGES = ('read', 'parse', 'minmax', 'colorize_rgb', 'colorize_gray', 'encode_png', 'hough', 'anchor')
+DRIVERS = ('cf_file_to_rgb', 'cf_file_to_array', 'cf_iter_pipeline', 'cf_file_to_rgb_by_hough_circle')
+
+def make_synthetic_frames(folder, count, shape=FRAME_SHAPE, anchors=5, seed=0):
+    """
+    Write count frames of 1-decimal temperature, trailing comma and CRLF like the camera output
+    a warm background with noise and anchors drifting slowly across the frames
+    [Output] (list) file paths in order
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    row, col = shape
+    yy, xx = np.mgrid[:row, :col]
+    background = 28 + 4*xx/col + 2*yy/row
+
+    paths = []
+    for i in range(count):
+        mat = background + rng.normal(0, 0.15, shape)
+        for k in range(anchors):
+            cx = (k+1) * col / (anchors+1) + 0.2*i
+            cy = row / 3 + (k % 2) * row / 3 + 0.1*i
+            mat[(xx-cx)**2 + (yy-cy)**2 <= 64] += 6
+
+        lines = [','.join('{:.1f}'.format(v) for v in line) + ',' for line in mat]
+        path = join(folder, '{:06d}.txt'.format(i))
+        with open(path, 'w', newline='') as f:
+            f.write('\r\n'.join(lines) + '\r\n')
+        paths.append(path)
+    return paths
+
+def peak_rss_kb():
+    """
+    [Output] (dict) peak resident set size in KB of this process and the finished workers
+    """
+    if resource is None:
+        return {'self': None, 'children': None}
+    # ru_maxrss is in bytes on macOS, KB on Linux
+    unit = 1024 if sys.platform == 'darwin' else 1
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // unit,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // unit
+    }
+
+class Benchmark(object):
+    """
+    Time the stages in this process and the ConcurrentConverter drivers across worker counts
+    each measurement is the best of repeat runs
+
+    [Input]
+        paths: ThermaCAM .txt frames, see make_synthetic_frames
+        workers: list of worker counts for the drivers
+        backend: 'process', 'thread' or 'serial'
+        repeat: number of runs of each measurement
+        output_dir: where the drivers save the images, default to a temp directory
+    """
+    def __init__(self, paths, workers=(1,), backend='process', repeat=3, output_dir=None, reader=None):
+        super().__init__()
+        self.paths = list(paths)
+        self.workers = list(workers)
+        self.backend = backend
+        self.repeat = repeat
+        self.output_dir = output_dir
+        self.reader = reader or ThermaCAMReader()
+
+    def __repr__(self):
+        return '{}(frames={}, workers={}, backend={}, repeat={})'.format(
+            self.__class__.__name__, len(self.paths), self.workers, self.backend, self.repeat)
+
+    def best_of(self, fn):
+        """[Output] the shortest seconds of repeat runs"""
+        seconds = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+        return min(seconds)
+
+    @staticmethod
+    def rate(frames, seconds):
+        return {
+            'frames': frames,
+            'seconds': seconds,
+            'fps': frames / seconds if seconds else None,
+            'ms_per_frame': 1e3 * seconds / frames if frames else None
+        }
+
+    def run_stages(self, stages=STAGES):
+        """
+        Time each stage alone on all of the frames, the input of each stage is prepared beforehand
+        [Output] (dict) stage name to rate
+        """
+        raw = []
+        for path in self.paths:
+            with open(path, 'rb') as f:
+                raw.append(f.read())
+        mats = [self.reader.parse(data, file_path=path) for path, data in zip(self.paths, raw)]
+        heat_maps = [HeatMap(mat) for mat in mats]
+        rgbs = [heat_map.transform_to_rgb() for heat_map in heat_maps]
+
+        def read():
+            for path in self.paths:
+                with open(path, 'rb') as f:
+                    f.read()
+
+        def anchor():
+            detector = AnchorDetector()
+            for mat in mats:
+                detector.detect(mat)
+
+        jobs = {
+            'read': read,
+            'parse': lambda: [self.reader.parse(data) for data in raw],
+            'minmax': lambda: [HeatMap(mat) for mat in mats],
+            'colorize_rgb': lambda: [heat_map.transform_to_rgb() for heat_map in heat_maps],
+            'colorize_gray': lambda: [heat_map.transform_to_gray() for heat_map in heat_maps],
+            'encode_png': lambda: [cv2.imencode('.png', rgb) for rgb in rgbs],
+            'hough': lambda: [Converter.heatmap_to_rgb_by_hough_circle(h) for h in heat_maps],
+            'anchor': anchor
+        }
+
+        results = {}
+        for stage in stages:
+            results[stage] = self.rate(len(self.paths), self.best_of(jobs[stage]))
+            LOGGER.info('{}: {:.1f} frames/s'.format(stage, results[stage]['fps']))
+        return results
+
+    def run_drivers(self, drivers=DRIVERS):
+        """
+        Time the end-to-end drivers with a fresh executor for each worker count
+        the pool is started before timing
+        [Output] (list) of dict of driver, backend, workers and rate
+        """
+        output_dir = self.output_dir or tempfile.mkdtemp(prefix='thermal-benchmark-')
+        cb_save = lambda path: join(output_dir, os.path.basename(path).replace('.txt', '.png'))
+        jobs = {
+            'cf_file_to_rgb': lambda executor: ConcurrentConverter.cf_file_to_rgb(
+                self.paths, cb_save, reader=self.reader, executor=executor),
+            'cf_file_to_array': lambda executor: ConcurrentConverter.cf_file_to_array(
+                self.paths, reader=self.reader, executor=executor),
+            'cf_iter_pipeline': lambda executor: list(ConcurrentConverter.cf_iter_pipeline(
+                self.paths, cb_save=cb_save, reader=self.reader, executor=executor)),
+            'cf_file_to_rgb_by_hough_circle': lambda executor: ConcurrentConverter.cf_file_to_rgb_by_hough_circle(
+                self.paths, reader=self.reader, executor=executor)
+        }
+
+        results = []
+        try:
+            for workers in self.workers:
+                with ConverterExecutor(self.backend, workers) as executor:
+                    # warm up the pool
+                    list(executor.map(abs, range(workers)))
+                    for driver in drivers:
+                        rate = self.rate(len(self.paths), self.best_of(lambda: jobs[driver](executor)))
+                        rate.update(driver=driver, backend=self.backend, workers=workers)
+                        results.append(rate)
+                        LOGGER.info('{} workers={}: {:.1f} frames/s'.format(driver, workers, rate['fps']))
+        finally:
+            if self.output_dir is None:
+                shutil.rmtree(output_dir, ignore_errors=True)
+        return results
+
+    def run(self, stages=STAGES, drivers=DRIVERS):
+        """
+        [Output] (dict) machine-readable report, with the per-stage metrics of the drivers if enabled
+        """
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'opencv': cv2.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count()
+            },
+            'config': {
+                'frames': len(self.paths),
+                'workers': self.workers,
+                'backend': self.backend,
+                'repeat': self.repeat
+            },
+            'stages': self.run_stages(stages)
+        }
+        metrics.METRICS.reset()
+        report['drivers'] = self.run_drivers(drivers)
+        report['peak_rss_kb'] = peak_rss_kb()
+        if metrics.is_enabled():
+            report['metrics'] = metrics.METRICS.summary()
+        return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark parse, colorize, Hough and conversion drivers')
+    parser.add_argument('--frames', type=int, default=64, help='number of synthetic frames')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    parser.add_argument('--backend', default='process', choices=['process', 'thread', 'serial'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='*', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--drivers', nargs='*', default=list(DRIVERS), choices=DRIVERS)
+    parser.add_argument('--data-dir', help='keep the synthetic frames here, default to a temp directory')
+    parser.add_argument('--metrics', action='store_true', help='report the per-stage metrics of the drivers')
+    parser.add_argument('--out', help='write the JSON report here, default to stdout')
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.enable()
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='thermal-frames-')
+    try:
+        paths = make_synthetic_frames(data_dir, args.frames)
+        benchmark = Benchmark(paths, sorted(set(args.workers)), args.backend, args.repeat)
+        report = benchmark.run(args.stages, args.drivers)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(filename)12s:L%(lineno)3s [%(levelname)8s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        stream=sys.stderr
+    )
+    main()
@@ -0,0 +1,85 @@
+"""
+cache.py
+    [class] FrameCache: parse ThermaCAM .txt once and reuse the binary .npy
+"""
+import hashlib
+import logging
+import os
+from glob import glob
+from os.path import abspath, join
+
+import numpy as np
+
+from .reader import DEFAULT_READER
+
+LOGGER = logging.getLogger(__name__)
+
+class FrameCache(object):
+    """
+    Store each parsed frame as .npy in cache_dir, keyed by source path, mtime and size.
+    The entry is invalid once the source changed and rebuilt on the next read.
+    Use it wherever a reader is accepted.
+
+    [Input]
+        cache_dir: directory to save the .npy
+        reader: ThermaCAMReader to parse the source on cache miss
+        mmap_mode: mmap_mode of np.load, None to load in memory
+    """
+    def __init__(self, cache_dir, reader=None, mmap_mode='r'):
+        super().__init__()
+        self.cache_dir = abspath(cache_dir)
+        self.reader = reader or DEFAULT_READER
+        self.mmap_mode = mmap_mode
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return '{}(cache_dir={}, reader={})'.format(
+            self.__class__.__name__, self.cache_dir, self.reader)
+
+    def _entry_prefix(self, file_path):
+        """different reader setting gets a different entry of the same source"""
+        key = '{}|{}'.format(abspath(file_path), self.reader)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def cache_path(self, file_path):
+        stat = os.stat(file_path)
+        return join(self.cache_dir, '{}-{}-{}.npy'.format(
+            self._entry_prefix(file_path), stat.st_mtime_ns, stat.st_size))
+
+    def _store(self, file_path, saved_path):
+        mat = self.reader.read(file_path)
+
+        # remove the entries of the outdated source
+        for stale_path in glob(join(self.cache_dir, self._entry_prefix(file_path) + '-*.npy')):
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+
+        # write to temp file and rename, another process never read the partial file
+        temp_path = '{}.{}.tmp'.format(saved_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.save(f, mat)
+        os.replace(temp_path, saved_path)
+        LOGGER.debug('Cache {} in {}'.format(file_path, saved_path))
+        return mat
+
+    def read(self, file_path, out=None):
+        """
+        [Input] file path, out: preallocated ndarray
+        [Output] (ndarray) matrix, read-only memory-mapped if hit the cache
+        """
+        saved_path = self.cache_path(file_path)
+        try:
+            mat = np.load(saved_path, mmap_mode=self.mmap_mode)
+        except (IOError, ValueError, EOFError):
+            mat = self._store(file_path, saved_path)
+
+        if out is None:
+            return mat
+        out[...] = mat
+        return out
+
+    def clear(self):
+        for saved_path in glob(join(self.cache_dir, '*.npy')):
+            os.remove(saved_path)
@@ -1,48 +1,197 @@
 """
 color.py
+    [func] register_colormap / get_colormap: module-level lookup table shared by all Palette
     [class] Palette: define the pair of color
+    [class] Normalization: per-frame or fixed temperature range to palette index
     [class] ColorTransformation: transform the value to meaningful color pair
 """
 import logging
+from collections import namedtuple
+
+import numpy as np
 
 
 LOGGER = logging.getLogger(__name__)
+LUT_SIZE = 256
+
+# lut: (256, 3) uint8 rgb, lut_float: (256, 3) float64 rgb, delta: lut_float[i+1] - lut_float[i]
+Colormap = namedtuple('Colormap', ['name', 'lut', 'lut_float', 'delta'])
+
+_COLORMAPS = {}
+_COLORMAP_FACTORIES = {}
+
+def _build_colormap(name, colors):
+    colors = np.asarray(colors, dtype=np.float64)
+    if colors.ndim != 2 or colors.shape[1] != 3:
+        raise ValueError('colormap {} should be (N, 3) rgb, got {}'.format(name, colors.shape))
+
+    # resample to 256 entries
+    if len(colors) != LUT_SIZE:
+        src = np.linspace(0, 1, len(colors))
+        dst = np.linspace(0, 1, LUT_SIZE)
+        colors = np.stack([np.interp(dst, src, colors[:, c]) for c in range(3)], axis=1)
+
+    delta = np.zeros_like(colors)
+    delta[:-1] = colors[1:] - colors[:-1]
+    lut = np.clip(colors, 0, 255).astype(np.uint8)
+    for array in (lut, colors, delta):
+        array.setflags(write=False)
+    return Colormap(name, lut, colors, delta)
+
+def register_colormap(name, colors):
+    """
+    Register the colormap by (N, 3) rgb colors in 0..255, resampled to 256 entries
+    colors can be a callable returning the colors, evaluated at the first use
+    """
+    _COLORMAPS.pop(name, None)
+    if callable(colors):
+        _COLORMAP_FACTORIES[name] = colors
+    else:
+        _COLORMAPS[name] = _build_colormap(name, colors)
+
+def get_colormap(name):
+    """
+    [Input] registered name, or name of OpenCV colormap e.g. 'jet' for cv2.COLORMAP_JET
+    [Output] Colormap
+    """
+    if isinstance(name, Colormap):
+        return name
+    if name not in _COLORMAPS:
+        if name in _COLORMAP_FACTORIES:
+            _COLORMAPS[name] = _build_colormap(name, _COLORMAP_FACTORIES[name]())
+        else:
+            _COLORMAPS[name] = _build_colormap(name, _opencv_colors(name))
+    return _COLORMAPS[name]
+
+def list_colormaps():
+    return sorted(set(_COLORMAPS) | set(_COLORMAP_FACTORIES))
+
+def _opencv_colors(name):
+    """the same colors as cv2.applyColorMap in rgb order"""
+    import cv2
+    code = getattr(cv2, 'COLORMAP_{}'.format(str(name).upper()), None)
+    if code is None:
+        raise KeyError('unknown colormap {}, registered: {}'.format(name, list_colormaps()))
+    bgr = cv2.applyColorMap(np.arange(LUT_SIZE, dtype=np.uint8).reshape(-1, 1), code)
+    return bgr.reshape(-1, 3)[:, ::-1]
+
+def _temperature_colors():
+    """From (0, 0, 255) to (255, 0, 0), total 256 segments to present"""
+    red = np.arange(0, 256)
+    green = np.concatenate([np.arange(0, 255, 2), np.arange(255, 0, -2)])
+    blue = np.arange(255, -1, -1)
+    return np.stack([red, green, blue], axis=1)
+
+def _anchor_colors(anchors):
+    """interpolate the (position, (r, g, b)) anchors into 256 colors"""
+    position = [p for p, _ in anchors]
+    colors = np.array([c for _, c in anchors], dtype=np.float64)
+    dst = np.linspace(0, 1, LUT_SIZE)
+    return np.stack([np.interp(dst, position, colors[:, c]) for c in range(3)], axis=1)
+
+register_colormap('temperature', _temperature_colors)
+register_colormap('ironbow', lambda: _anchor_colors([
+    (0.0, (0, 0, 0)), (0.2, (32, 0, 140)), (0.45, (204, 0, 119)),
+    (0.7, (255, 165, 0)), (0.85, (255, 215, 0)), (1.0, (255, 255, 255))
+]))
+register_colormap('rainbow', lambda: _anchor_colors([
+    (0.0, (0, 0, 255)), (0.25, (0, 255, 255)), (0.5, (0, 255, 0)),
+    (0.75, (255, 255, 0)), (1.0, (255, 0, 0))
+]))
+
+GRAYSCALE = np.arange(LUT_SIZE, dtype=np.uint8)
+GRAYSCALE.setflags(write=False)
 
 class Palette(object):
     """
-    Palette
+    Palette of the registered colormap, the lookup table is shared by all Palette
     """
-    def __init__(self):
-        self._temperature_rgb = None
-        self._grayscale = None
+    def __init__(self, colormap='temperature'):
+        self.colormap = colormap
 
     @property
     def temperature_rgb(self):
-        """
-        From (0, 0, 255) to (255, 0, 0), total 256 segments to present
-        TODO: using np.linspace to arrange number scope
-        """
-        if self._temperature_rgb is None:
-            red = [r for r in range(0, 256)]
-            green = [g for g in range(0, 255, 2)] + [g for g in range(255, 0, -2)]
-            blue = [b for b in range(255, -1, -1)]
-            self._temperature_rgb = [(red[i], green[i], blue[i]) for i in range(len(red))]
-        return self._temperature_rgb
+        """(256, 3) rgb of the colormap, default from (0, 0, 255) to (255, 0, 0)"""
+        return get_colormap(self.colormap).lut_float
 
     @property
     def grayscale(self):
         """from 0 (black) to 255 (white)"""
-        if self._grayscale is None:
-            self._grayscale = [i for i in range(256)]
-        return self._grayscale
+        return GRAYSCALE
+
+class Normalization(object):
+    """
+    Normalize the temperature to palette index by one affine transform
+        index = (value - heat_min) * max_index / (heat_max - heat_min)
+    per-frame range if heat_min and heat_max are None, otherwise the fixed range is shared
+    by all frames, the scale is computed once and the frames are comparable across a recording
+    value without variation (heat_max == heat_min) maps to index 0
+
+    [Input] heat_min, heat_max: fixed range e.g. 20, 40 or dataset-wide range
+    """
+    def __init__(self, heat_min=None, heat_max=None):
+        super().__init__()
+        if (heat_min is None) != (heat_max is None):
+            raise ValueError('heat_min and heat_max should be both given or both None')
+        if heat_min is not None and heat_max < heat_min:
+            raise ValueError('heat_max {} is less than heat_min {}'.format(heat_max, heat_min))
+        self.heat_min = None if heat_min is None else float(heat_min)
+        self.heat_max = None if heat_max is None else float(heat_max)
+        self._scales = {}
+
+    def __repr__(self):
+        return '{}(heat_min={}, heat_max={})'.format(
+            self.__class__.__name__, self.heat_min, self.heat_max)
+
+    @property
+    def is_fixed(self):
+        return self.heat_min is not None
+
+    def range_of(self, mat, axis=None):
+        """
+        [Input] (ndarray) matrix, axis: reduce per frame e.g. (-2, -1) for (N, H, W)
+        [Output] (heat_min, heat_max) of the fixed range, or of the matrix
+        """
+        if self.is_fixed:
+            return self.heat_min, self.heat_max
+        mat = np.asarray(mat)
+        keepdims = axis is not None
+        return mat.min(axis=axis, keepdims=keepdims), mat.max(axis=axis, keepdims=keepdims)
+
+    def scale(self, max_index=LUT_SIZE-1):
+        """precomputed scale of the fixed range"""
+        if not self.is_fixed:
+            raise ValueError('per-frame normalization has no fixed scale')
+        if max_index not in self._scales:
+            self._scales[max_index] = Normalization.scale_of(self.heat_min, self.heat_max, max_index)
+        return self._scales[max_index]
+
+    @staticmethod
+    def scale_of(minval, maxval, max_index):
+        """
+        max_index / (maxval - minval), 0 where there is no variation
+        minval and maxval can be scalar or array e.g. (N, 1, 1)
+        """
+        heat_range = np.subtract(maxval, minval, dtype=np.float64)
+        scale = np.zeros_like(heat_range)
+        np.divide(max_index, heat_range, out=scale, where=heat_range > 0)
+        return scale if scale.ndim else float(scale)
 
 class ColorTransformation(object):
     """Color transformation just like color interpolation"""
+    @staticmethod
+    def palette_index(value, minval, maxval, max_index):
+        """Convert value in range minval...maxval to float index 0..max_index, 0 if no variation"""
+        if maxval == minval:
+            return 0.0
+        transform_value = (float(value-minval) / (maxval-minval)) * max_index
+        return min(max(transform_value, 0), max_index)
+
     @staticmethod
     def color_transformation(value, minval, maxval, palette):
         """Convert value in range minval...maxval to the range 0..max_index"""
         max_index = len(palette)-1
-        transform_value = (float(value-minval) / (maxval-minval)) * max_index
+        transform_value = ColorTransformation.palette_index(value, minval, maxval, max_index)
         int_value, float_value = divmod(transform_value, 1)
         int_value = int(int_value)
 
@@ -57,7 +206,7 @@ class ColorTransformation(object):
     def gray_transformation(value, minval, maxval, palette):
         """Covert value to gray"""
         max_index = len(palette)-1
-        transform_value = (float(value-minval) / (maxval-minval)) * max_index
+        transform_value = ColorTransformation.palette_index(value, minval, maxval, max_index)
         int_value, float_value = divmod(transform_value, 1)
         int_value = int(int_value)
 
@@ -68,8 +217,96 @@ class ColorTransformation(object):
 
         return g0+gd
 
+    @staticmethod
+    def palette_index_array(mat, minval, maxval, max_index, scale=None):
+        """
+        Convert the whole matrix in range minval...maxval to float index 0..max_index
+        minval and maxval can be scalar or array broadcast to mat, e.g. (N, 1, 1)
+        scale: precomputed Normalization.scale_of(minval, maxval, max_index)
+        """
+        if scale is None:
+            scale = Normalization.scale_of(minval, maxval, max_index)
+        index = np.subtract(mat, minval, dtype=np.float64)
+        index *= scale
+        np.clip(index, 0, max_index, out=index)
+        return index
+
+    @staticmethod
+    def color_transformation_array(mat, minval, maxval, palette, out=None, scale=None):
+        """
+        Vectorized color_transformation for the whole matrix in one pass
+        [Input] (ndarray) matrix in shape (..., H, W)
+        [Output] (ndarray) uint8 rgb in shape (..., H, W, 3), write into out if given
+        """
+        if isinstance(palette, Colormap):
+            palette, palette_delta = palette.lut_float, palette.delta
+        else:
+            palette = np.asarray(palette, dtype=np.float64)
+            palette_delta = np.zeros_like(palette)
+            palette_delta[:-1] = palette[1:] - palette[:-1]
+        max_index = len(palette)-1
+
+        transform_value = ColorTransformation.palette_index_array(
+            mat, minval, maxval, max_index, scale)
+        int_value = transform_value.astype(np.intp)
+        transform_value -= int_value
+        color = palette_delta[int_value]
+        color *= transform_value[..., None]
+        color += palette[int_value]
+
+        if out is None:
+            out = np.empty(color.shape, dtype=np.uint8)
+        np.copyto(out, color, casting='unsafe')
+        return out
+
+    @staticmethod
+    def gray_transformation_array(mat, minval, maxval, palette, out=None, scale=None):
+        """
+        Vectorized gray_transformation for the whole matrix in one pass
+        [Input] (ndarray) matrix in shape (..., H, W)
+        [Output] (ndarray) uint8 gray in shape (..., H, W), write into out if given
+        """
+        palette = np.asarray(palette, dtype=np.uint8)
+        max_index = len(palette)-1
+
+        transform_value = ColorTransformation.palette_index_array(
+            mat, minval, maxval, max_index, scale)
+        int_value = transform_value.astype(np.intp)
+
+        # same as gray_transformation, take the upper one of the nearest pair
+        np.minimum(int_value+1, max_index, out=int_value)
+
+        if out is None:
+            out = np.empty(int_value.shape, dtype=np.uint8)
+        np.take(palette, int_value, out=out)
+        return out
+
+    @staticmethod
+    def quantize_transformation_array(mat, minval, maxval, out=None, scale=None):
+        """
+        Quantize the whole matrix to uint8 palette index 0..255
+        [Output] (ndarray) uint8 index in the same shape of mat
+        """
+        transform_value = ColorTransformation.palette_index_array(
+            mat, minval, maxval, LUT_SIZE-1, scale)
+        if out is None:
+            out = np.empty(transform_value.shape, dtype=np.uint8)
+        np.copyto(out, transform_value, casting='unsafe')
+        return out
+
+    @staticmethod
+    def lut_transformation_array(index, lut, out=None):
+        """
+        Fast path without interpolation, map the uint8 index through the lookup table
+        [Input] (ndarray) uint8 index, lut: Colormap or (256, C) uint8 array
+        [Output] (ndarray) uint8 in shape index.shape + (C,)
+        """
+        if isinstance(lut, Colormap):
+            lut = lut.lut
+        return np.take(lut, index, axis=0, out=out)
+
     @staticmethod
     def colorize(value, minval, maxval, palette):
         """Convert value to color tag"""
         color = ColorTransformation.color_transformation(value, minval, maxval, palette)
-        return '#' + '%02x' % color[0] + '%02x' % color[1] + '%02x' % color[2]
+        return '#' + '%02x' % int(color[0]) + '%02x' % int(color[1]) + '%02x' % int(color[2])
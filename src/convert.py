@@ -2,17 +2,48 @@
 convert.py
     [class] Converter
 """
+import heapq
 import logging
-from concurrent.futures import ProcessPoolExecutor
+import os
+import threading
+from collections import Counter, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+from functools import partial
+from itertools import chain, islice
 from os import listdir, makedirs, sep
-from os.path import abspath, dirname, exists, join
+from os.path import abspath, dirname, exists, join, splitext
 
 import cv2
 import numpy as np
 
-from .heatmap import HeatMap
+from . import metrics
+from .anchor import AnchorDetector
+from .color import Normalization
+from .executor import get_executor
+from .heatmap import HeatMap, HeatMapStack
+from .order import natural_key
+from .pack import FramePack
+from .pipeline import StagedPipeline
+from .prefilter import ACCEPTED
+from .projection import TemporalProjection
+from .reader import DEFAULT_READER
+from .shared import SharedFrameBuffer
+from .sink import ReorderBuffer
+from .stats import calc_frame_stats
 
 LOGGER = logging.getLogger(__name__)
+# number of frames converted by a worker in one vectorized call
+BATCH_SIZE = 16
+# number of consecutive frames an AnchorDetector tracks in one task
+ANCHOR_BATCH_SIZE = 64
+
+# result of the frame converted and saved by the worker
+FrameStatus = namedtuple('FrameStatus', ['path', 'saved_path', 'saved', 'message'])
+# outputs of the single-read conversion, see ConcurrentConverter.cf_file_to_outputs
+OUTPUTS = ('rgb', 'gray', 'stats', 'anchors')
+# images: output to image not saved, saved: output to saved path or None if failed,
+# stats: FrameStats, anchors: AnchorResult, None if not requested
+FrameOutputs = namedtuple('FrameOutputs', ['path', 'images', 'saved', 'stats', 'anchors', 'message'])
 
 class Converter(object):
     """
@@ -30,38 +61,351 @@ class Converter(object):
         return self._template_iter_tuple(max, l, 1) - self._template_iter_tuple(min, l, 1)
 
     @staticmethod
-    def file_to_heatmap(file_path):
-        np_heat_map = np.loadtxt(open(file_path, 'rb'), delimiter=',', skiprows=1)
-        heat_map = HeatMap(np_heat_map)
+    def frame_source(paths, reader=None):
+        """
+        Accept a list of file paths or FramePack as the source
+        [Output] (list of file paths, reader)
+        """
+        if isinstance(paths, FramePack):
+            return paths.paths, paths
+        return paths, reader
+
+    @staticmethod
+    def file_to_heatmap(file_path, reader=None, colormap='temperature', normalization=None):
+        """
+        [Input] file path, reader: ThermaCAMReader, default to DEFAULT_READER
+                colormap: registered name, see color.list_colormaps()
+                normalization: Normalization, default to the per-frame range
+        [Output] HeatMap
+        """
+        reader = reader or DEFAULT_READER
+        np_heat_map = reader.read(file_path)
+        heat_map = HeatMap(np_heat_map, colormap=colormap or 'temperature', normalization=normalization)
         return heat_map
 
     @staticmethod
-    def file_to_rgb(file_path):
-        heat_map = Converter.file_to_heatmap(file_path)
-        np_heat_rgb = np.array(heat_map.transform_to_rgb(), np.uint8)
+    def file_to_image_and_stats(file_path, mode='rgb', reader=None, colormap=None, normalization=None):
+        """
+        [Input] file path, mode: 'rgb' or 'gray'
+        [Output] (ndarray, FrameStats) image and statistics from the same parse
+        """
+        heat_map = Converter.file_to_heatmap(file_path, reader, colormap, normalization)
+        if mode == 'gray':
+            return heat_map.transform_to_gray(), heat_map.stats()
+        return heat_map.transform_to_rgb(), heat_map.stats()
+
+    @staticmethod
+    def frame_shape(paths, reader=None):
+        """
+        [Output] (row, col) of the frame from the reader setting, or parse the first frame
+        """
+        if isinstance(reader, FramePack):
+            return reader.frames.shape[1:]
+        shape = getattr(reader or DEFAULT_READER, 'shape', None)
+        if shape is not None:
+            return shape
+        return Converter.file_to_heatmap(paths[0], reader).mat.shape
+
+    @staticmethod
+    def file_to_buffer(file_path, index, buffer, mode='rgb', reader=None, colormap=None,
+                       normalization=None):
+        """
+        Convert and write into SharedFrameBuffer at index instead of returning the image
+        [Input] file path, index, buffer: SharedFrameBuffer, mode: 'rgb' or 'gray'
+        [Output] index
+        """
+        heat_map = Converter.file_to_heatmap(file_path, reader, colormap, normalization)
+        array = buffer.attach().array
+        if mode == 'gray':
+            heat_map.transform_to_gray(out=array[index])
+        else:
+            heat_map.transform_to_rgb(out=array[index])
+        return index
+
+    @staticmethod
+    def write_image(saved_path, image):
+        """
+        Encode and write to a temp file then rename, a partial image never shows up at saved_path
+        """
+        root, ext = splitext(saved_path)
+        temp_path = '{}.{}-{}.tmp{}'.format(root, os.getpid(), threading.get_ident(), ext)
+        with metrics.timer('encode_write'):
+            if not cv2.imwrite(temp_path, image):
+                raise IOError('cannot encode {}'.format(saved_path))
+            os.replace(temp_path, saved_path)
+
+    @staticmethod
+    def file_to_saved(file_path, saved_path, mode='rgb', draw_circle=False, reader=None,
+                      colormap=None, normalization=None):
+        """
+        Convert, encode and write the image in the worker
+        the image is the same as the one saved by ConcurrentConverter in the parent
+        [Input] file path, saved path, mode: 'rgb', 'gray' or 'hough'
+        [Output] FrameStatus
+        """
+        try:
+            if mode == 'hough':
+                image = Converter.file_to_rgb_by_hough_circle(file_path, draw_circle, reader)
+                if image is None:
+                    # rejected frame has nothing to save
+                    return FrameStatus(file_path, None, False, 'not enough hough circles')
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            elif mode == 'gray':
+                image = Converter.file_to_grayscale(file_path, reader, normalization)
+            else:
+                image = Converter.file_to_rgb(file_path, reader, colormap, normalization)
+
+            Converter.write_image(saved_path, image)
+            metrics.count('frames_saved')
+            return FrameStatus(file_path, saved_path, True, '')
+        except Exception as e:
+            LOGGER.exception('{}'.format(e))
+            metrics.count('frames_failed')
+            return FrameStatus(file_path, saved_path, False, '{}'.format(e))
+
+    @staticmethod
+    def file_to_rgb(file_path, reader=None, colormap=None, normalization=None):
+        heat_map = Converter.file_to_heatmap(file_path, reader, colormap, normalization)
+        np_heat_rgb = heat_map.transform_to_rgb()
         return np_heat_rgb
 
     @staticmethod
-    def file_to_grayscale(file_path):
-        heat_map = Converter.file_to_heatmap(file_path)
-        np_heat_gray = np.array(heat_map.transform_to_gray(), np.uint8)
+    def file_to_grayscale(file_path, reader=None, normalization=None):
+        heat_map = Converter.file_to_heatmap(file_path, reader, normalization=normalization)
+        np_heat_gray = heat_map.transform_to_gray()
         return np_heat_gray
 
     @staticmethod
-    def file_to_rgb_by_hough_circle(file_path, draw_circle=False):
+    def files_to_stack(paths, reader=None, raw=None):
+        """
+        [Input] file paths, reader: ThermaCAMReader, FrameCache or FramePack
+                raw: content of each file read by read_raw, parse instead of read
+        [Output] (ndarray) matrices in shape (N, H, W)
+        """
+        reader = reader or DEFAULT_READER
+        if isinstance(reader, FramePack):
+            return reader.frames[[reader.index_of(path) for path in paths]]
+
+        def read(i, out=None):
+            if raw is None or raw[i] is None:
+                return reader.read(paths[i], out=out)
+            return reader.parse(raw[i], out=out, file_path=paths[i])
+
+        first = read(0)
+        stack = np.empty((len(paths),) + first.shape, dtype=first.dtype)
+        stack[0] = first
+        for i in range(1, len(paths)):
+            read(i, out=stack[i])
+        return stack
+
+    @staticmethod
+    def read_raw(paths, reader=None):
+        """
+        I/O stage of the pipeline, read the content of the text frames without parsing
+        the reader without parse e.g. FrameCache and FramePack reads in the compute stage
+        [Output] (paths, list of bytes or None)
+        """
+        if not hasattr(reader or DEFAULT_READER, 'parse'):
+            return paths, [None]*len(paths)
+        raw = []
+        for path in paths:
+            with metrics.timer('read'), open(path, 'rb') as f:
+                raw.append(f.read())
+        return paths, raw
+
+    @staticmethod
+    def raw_to_images(chunk, mode='rgb', reader=None, colormap=None, normalization=None):
+        """
+        Compute stage of the pipeline, parse and convert a chunk of frames
+        [Input] (paths, raw) from read_raw
+        [Output] (paths, (ndarray) uint8 images in shape (N, H, W, 3) or (N, H, W))
+        """
+        paths, raw = chunk
+        stack = Converter.files_to_stack(paths, reader, raw)
+        if mode == 'gray':
+            return paths, Converter.stack_to_grayscale(stack, normalization)
+        return paths, Converter.stack_to_rgb(stack, colormap, normalization)
+
+    @staticmethod
+    def raw_to_hough_images(chunk, draw_circle=False, reader=None, detector=None, prefilter=None):
+        """
+        Compute stage of the pipeline by hough circle, see files_to_rgb_by_hough_circle
+        [Input] (paths, raw) of consecutive frames from read_raw
+        [Output] (paths, list of bgr image or None if rejected)
+        """
+        paths, raw = chunk
+        images, _ = Converter.files_to_rgb_by_hough_circle(
+            paths, draw_circle, reader, detector, prefilter, raw=raw)
+        return paths, [None if rgb is None else cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR) for rgb in images]
+
+    @staticmethod
+    def write_images(chunk, cb_save, created=None):
+        """
+        Write stage of the pipeline
+        [Input] (paths, images) from raw_to_images or raw_to_hough_images
+                cb_save: callback from source path to saved path
+                created: set of the directories already created, shared across the chunks of a job
+        [Output] (list) FrameStatus of each path, the rejected frame is not saved
+        """
+        created = set() if created is None else created
+        saved_paths = [None if image is None else cb_save(path) for path, image in zip(*chunk)]
+        directories = set(dirname(saved_path) for saved_path in saved_paths if saved_path is not None) - created
+        if directories:
+            with metrics.timer('makedirs'):
+                for directory in directories:
+                    makedirs(directory, exist_ok=True)
+            created.update(directories)
+
+        statuses = []
+        for path, image, saved_path in zip(*chunk, saved_paths):
+            if image is None:
+                metrics.count('frames_rejected')
+                statuses.append(FrameStatus(path, None, False, 'not enough hough circles'))
+                continue
+            try:
+                Converter.write_image(saved_path, image)
+                metrics.count('frames_saved')
+                statuses.append(FrameStatus(path, saved_path, True, ''))
+            except Exception as e:
+                LOGGER.exception('{}'.format(e))
+                metrics.count('frames_failed')
+                statuses.append(FrameStatus(path, saved_path, False, '{}'.format(e)))
+        return statuses
+
+    @staticmethod
+    def stack_to_rgb(stack, colormap=None, normalization=None, out=None):
+        """
+        [Input] (ndarray) matrices in shape (N, H, W), normalization: per-frame by default
+        [Output] (ndarray) uint8 rgb images in shape (N, H, W, 3)
+        """
+        heat_maps = HeatMapStack(stack, colormap or 'temperature', normalization)
+        return heat_maps.transform_to_rgb(out=out)
+
+    @staticmethod
+    def stack_to_grayscale(stack, normalization=None, out=None):
+        """
+        [Input] (ndarray) matrices in shape (N, H, W), normalization: per-frame by default
+        [Output] (ndarray) uint8 gray images in shape (N, H, W)
+        """
+        heat_maps = HeatMapStack(stack, normalization=normalization)
+        return heat_maps.transform_to_gray(out=out)
+
+    @staticmethod
+    def files_to_images(paths, mode='rgb', reader=None, colormap=None, normalization=None, out=None):
+        """
+        Convert a chunk of frames in one vectorized call
+        [Input] file paths, mode: 'rgb' or 'gray'
+        [Output] (ndarray) uint8 images in shape (N, H, W, 3) or (N, H, W)
+        """
+        stack = Converter.files_to_stack(paths, reader)
+        if mode == 'gray':
+            return Converter.stack_to_grayscale(stack, normalization, out=out)
+        return Converter.stack_to_rgb(stack, colormap, normalization, out=out)
+
+    @staticmethod
+    def files_to_encoded(paths, encoding='.png', mode='rgb', reader=None, colormap=None, normalization=None):
+        """
+        Convert a chunk of frames and encode each image e.g. for TarShardSink
+        the rgb image is encoded from BGR as cv2 expects, so it decodes to the colors of the colormap
+        [Output] (list) encoded image in bytes
+        """
+        images = Converter.files_to_images(paths, mode, reader, colormap, normalization)
+        encoded = []
+        for image in images:
+            with metrics.timer('encode'):
+                if image.ndim == 3:
+                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+                ok, data = cv2.imencode(encoding, image)
+            if not ok:
+                raise IOError('cannot encode {}'.format(encoding))
+            encoded.append(data.tobytes())
+        return encoded
+
+    @staticmethod
+    def files_to_buffer(paths, start, buffer, mode='rgb', reader=None, colormap=None,
+                        normalization=None):
+        """
+        Convert a chunk of frames and write into SharedFrameBuffer from start
+        [Output] start
+        """
+        array = buffer.attach().array
+        Converter.files_to_images(paths, mode, reader, colormap, normalization,
+                                  out=array[start:start+len(paths)])
+        return start
+
+    @staticmethod
+    def files_to_outputs(chunk, outputs=OUTPUTS, reader=None, colormap=None, normalization=None,
+                         detector=None):
+        """
+        Parse a chunk of frames once and emit every requested output from the same matrices
+        the min/max scan is shared by rgb and gray, the images with saved path are written here
+        [Input] (paths, dict of output to saved paths), outputs: subset of OUTPUTS
+                detector: AnchorDetector of 'anchors', tracked through the chunk
+        [Output] (list) FrameOutputs of each path
+        """
+        paths, saved_paths = chunk
+        stack = Converter.files_to_stack(paths, reader)
+        heat_maps = HeatMapStack(stack, colormap or 'temperature', normalization)
+        images = {}
+        if 'rgb' in outputs:
+            images['rgb'] = heat_maps.transform_to_rgb()
+        if 'gray' in outputs:
+            images['gray'] = heat_maps.transform_to_gray()
+        if 'anchors' in outputs:
+            detector = (detector or AnchorDetector()).fresh()
+
+        results = []
+        for i, (path, mat) in enumerate(zip(paths, stack)):
+            kept, saved, messages = {}, {}, []
+            for output, batch in images.items():
+                if output not in saved_paths:
+                    kept[output] = batch[i]
+                    continue
+                saved_path = saved_paths[output][i]
+                try:
+                    Converter.write_image(saved_path, batch[i])
+                    metrics.count('frames_saved')
+                    saved[output] = saved_path
+                except Exception as e:
+                    LOGGER.exception('{}'.format(e))
+                    metrics.count('frames_failed')
+                    saved[output] = None
+                    messages.append('{}: {}'.format(output, e))
+
+            stats = calc_frame_stats(mat) if 'stats' in outputs else None
+            anchors = None
+            if 'anchors' in outputs:
+                with metrics.timer('anchor'):
+                    anchors = detector.detect(mat, path)
+            results.append(FrameOutputs(path, kept, saved, stats, anchors, '; '.join(messages)))
+        return results
+
+    @staticmethod
+    def file_to_rgb_by_hough_circle(file_path, draw_circle=False, reader=None):
         """
         Find the anchor by Hough Circles
         ref: http://www.pyimagesearch.com/2014/07/21/detecting-circles-images-using-opencv-hough-circles/
         [Input] file path
         [Output] (ndarray) rgb image
         """
-        np_heat_rgb = Converter.file_to_rgb(file_path)
-        np_heat_gray = cv2.cvtColor(np_heat_rgb, cv2.COLOR_RGB2GRAY)
-        heat_map_circle = cv2.HoughCircles(np_heat_gray, cv2.HOUGH_GRADIENT, 1, 10,
-                                            param1=100,
-                                            param2=22,
-                                            minRadius=0,
-                                            maxRadius=25)
+        heat_map = Converter.file_to_heatmap(file_path, reader)
+        return Converter.heatmap_to_rgb_by_hough_circle(heat_map, draw_circle, file_path)
+
+    @staticmethod
+    def heatmap_to_rgb_by_hough_circle(heat_map, draw_circle=False, file_path=None):
+        """
+        see file_to_rgb_by_hough_circle
+        [Input] HeatMap
+        [Output] (ndarray) rgb image, None if less than 4 circles
+        """
+        np_heat_rgb = heat_map.transform_to_rgb()
+        with metrics.timer('hough'):
+            np_heat_gray = cv2.cvtColor(np_heat_rgb, cv2.COLOR_RGB2GRAY)
+            heat_map_circle = cv2.HoughCircles(np_heat_gray, cv2.HOUGH_GRADIENT, 1, 10,
+                                                param1=100,
+                                                param2=22,
+                                                minRadius=0,
+                                                maxRadius=25)
 
         if heat_map_circle is None:
             return
@@ -72,47 +416,287 @@ class Converter(object):
         LOGGER.info('{}: circle_count = {}'.format(file_path, len(heat_map_circle),))
 
         if draw_circle:
-            for c in heat_map_circle:
-                cv2.circle(np_heat_rgb, (c[0], c[1]), c[2], (0, 0, 0), 1)
-                cv2.circle(np_heat_rgb, (c[0], c[1]), 2, (255, 255, 255), 1)
+            AnchorDetector.draw(np_heat_rgb, heat_map_circle)
 
         return np_heat_rgb
 
     @staticmethod
-    def find_heatmap_by_temperature_difference(paths):
+    def files_to_anchors(paths, detector=None, reader=None):
         """
-        Find the maximum temperature difference from matrices
-        [Input] file paths
-        [Output] (ndarray) maximumn temperature difference heat map
+        Track the anchors through a chunk of consecutive frames
+        [Input] file paths in the order of recording, detector: AnchorDetector
+        [Output] (list) AnchorResult
         """
-        max_variation = None
-        temperature_diff = lambda x,y: abs(y-x)
+        detector = (detector or AnchorDetector()).fresh()
+        stack = Converter.files_to_stack(paths, reader)
+        anchors = []
+        for path, mat in zip(paths, stack):
+            with metrics.timer('anchor'):
+                anchors.append(detector.detect(mat, path))
+        return anchors
 
-        for i, obj in enumerate(paths):
-            heat_map = Converter.file_to_heatmap(obj)
+    @staticmethod
+    def files_to_rgb_by_hough_circle(paths, draw_circle=False, reader=None, detector=None, prefilter=None,
+                                     raw=None):
+        """
+        Convert a chunk of frames by hough circle, the rejected frame costs no rgb work
+        1. prefilter: FilterChain on the raw matrix
+        2. detector: AnchorDetector on the 8-bit matrix tracked through the chunk,
+           None for the rgb round trip of file_to_rgb_by_hough_circle
+        3. colorize the accepted frames
+        [Input] raw: content of each file read by read_raw, parse instead of read
+        [Output] (list of rgb image or None, Counter of the stage of each frame)
+        """
+        counts = Counter()
+        stack = Converter.files_to_stack(paths, reader, raw)
+        if detector is not None:
+            detector = detector.fresh()
+
+        images = [None]*len(paths)
+        accepted, anchors = [], {}
+        for i, (path, mat) in enumerate(zip(paths, stack)):
+            with metrics.timer('prefilter'):
+                stage = prefilter.check(mat) if prefilter is not None else None
+            if stage is not None:
+                counts[stage] += 1
+                continue
 
-            # boundary condition
-            if max_variation is None:
-                max_variation = heat_map
-                LOGGER.info('{}: iter {} heat_min={} heat_max={}'.format(
-                    obj, i, max_variation.heat_min, max_variation.heat_max
-                ))
+            if detector is None:
+                images[i] = Converter.heatmap_to_rgb_by_hough_circle(HeatMap(mat), draw_circle, path)
+                counts[ACCEPTED if images[i] is not None else 'hough'] += 1
                 continue
 
-            # condition
-            target = temperature_diff(max_variation.heat_min, max_variation.heat_max)
-            current = temperature_diff(heat_map.heat_min, heat_map.heat_max)
-            if current > target:
-                max_variation = heat_map
-                LOGGER.info('{}: iter {} heat_min={} heat_max={}'.format(
-                    obj, i, max_variation.heat_min, max_variation.heat_max
-                ))
+            with metrics.timer('anchor'):
+                anchors[i] = detector.detect(mat, path)
+            if anchors[i].accepted:
+                accepted.append(i)
+            counts[ACCEPTED if anchors[i].accepted else 'hough'] += 1
+
+        if accepted:
+            for i, rgb in zip(accepted, Converter.stack_to_rgb(stack[accepted])):
+                images[i] = AnchorDetector.draw(rgb, anchors[i].circles) if draw_circle else rgb
+        return images, counts
+
+    @staticmethod
+    def iter_chunks(paths, chunksize):
+        """
+        Split the iterable lazily
+        [Output] generator of (start index, list of paths)
+        """
+        iter_paths = iter(paths)
+        start = 0
+        while True:
+            chunk = list(islice(iter_paths, chunksize))
+            if not chunk:
+                return
+            yield start, chunk
+            start += len(chunk)
+
+    @staticmethod
+    def iter_bounded(fn, *iterables, executor=None, max_in_flight=None, ordered=True):
+        """
+        Lazy Executor.map, consume the iterables and submit only when a task is done
+        at most max_in_flight tasks and their results are held at once
+        [Input] fn, iterables, executor: ConverterExecutor, default to get_executor()
+                max_in_flight: default to 2 x max_workers
+                ordered: yield in the order of the iterables, otherwise as completed
+        [Output] generator of results
+        """
+        executor = executor or get_executor()
+        max_in_flight = max_in_flight or 2*executor.max_workers
+        futures = deque()
+        try:
+            for args in zip(*iterables):
+                if len(futures) >= max_in_flight:
+                    if ordered:
+                        with metrics.timer('wait'):
+                            result = futures.popleft().result()
+                        yield result
+                    else:
+                        with metrics.timer('wait'):
+                            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                        futures = deque(f for f in futures if f in pending)
+                        for future in done:
+                            yield future.result()
+                futures.append(executor.submit(fn, *args))
+
+            while futures:
+                if ordered:
+                    with metrics.timer('wait'):
+                        result = futures.popleft().result()
+                    yield result
+                else:
+                    with metrics.timer('wait'):
+                        done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                    futures = deque(f for f in futures if f in pending)
+                    for future in done:
+                        yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    @staticmethod
+    def items_to_images(items, mode='rgb', reader=None, colormap=None, normalization=None):
+        """
+        Convert a chunk of file paths or matrices in one vectorized call
+        [Input] list of file path or (H, W) ndarray
+        [Output] (ndarray) uint8 images in shape (N, H, W, 3) or (N, H, W)
+        """
+        if all(isinstance(item, np.ndarray) for item in items):
+            stack = np.stack(items)
+        else:
+            reader = reader or DEFAULT_READER
+            stack = np.stack([item if isinstance(item, np.ndarray) else reader.read(item) for item in items])
+        if mode == 'gray':
+            return Converter.stack_to_grayscale(stack, normalization)
+        return Converter.stack_to_rgb(stack, colormap, normalization)
+
+    @staticmethod
+    def temperature_range(paths, reader=None):
+        """
+        [Output] (heat_min, heat_max) over all of the matrices
+        """
+        reader = reader or DEFAULT_READER
+        heat_min, heat_max = float('inf'), float('-inf')
+        for path in paths:
+            mat = reader.read(path)
+            heat_min = min(heat_min, float(mat.min()))
+            heat_max = max(heat_max, float(mat.max()))
+        return heat_min, heat_max
+
+    @staticmethod
+    def files_to_projection(paths, reader=None):
+        """
+        [Input] file paths of a chunk
+        [Output] TemporalProjection of the chunk, read one frame at a time
+        """
+        reader = reader or DEFAULT_READER
+        projection = TemporalProjection()
+        for path in paths:
+            with metrics.timer('project'):
+                projection.update(reader.read(path))
+        return projection
+
+    @staticmethod
+    def heap_by_temperature_difference(paths, k=1, reader=None, start=0, with_stats=False):
+        """
+        Parse each matrix once and keep the top k temperature difference in bounded heap
+        the earlier frame wins if the temperature difference is the same, the difference is in float64
+        as FrameStatsIndex.top_by_temperature_difference so both pick the same frame
+        [Input] file paths, k, start: index of the first path
+                with_stats: also return the FrameStats of each path
+        [Output] (list) heap of (temperature_diff, -index, path, HeatMap)
+                 or (heap, list of (path, FrameStats)) if with_stats
+        """
+        heap, records = [], []
+        for i, path in enumerate(paths, start):
+            heat_map = Converter.file_to_heatmap(path, reader)
+            if with_stats:
+                records.append((path, heat_map.stats()))
+            item = (float(heat_map.heat_max) - float(heat_map.heat_min), -i, path, heat_map)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+        if with_stats:
+            return heap, records
+        return heap
+
+    @staticmethod
+    def merge_heap_by_temperature_difference(heaps, k=1):
+        """
+        Merge the heaps from heap_by_temperature_difference and keep the top k
+        [Output] (list) heap of (temperature_diff, -index, path, HeatMap)
+        """
+        heap = []
+        for partial_heap in heaps:
+            for item in partial_heap:
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+        return heap
+
+    @staticmethod
+    def sorted_by_temperature_difference(heap):
+        """
+        [Output] (list) of (path, HeatMap) in descending temperature difference
+        """
+        heap = sorted(heap, key=lambda x: x[:2], reverse=True)
+        return [(path, heat_map) for _, _, path, heat_map in heap]
+
+    @staticmethod
+    def select_from_pack_by_temperature_difference(pack, k=1):
+        """
+        Answer by the per-frame min/max in the index of FramePack without parsing
+        [Output] (list) of (path, HeatMap) in descending temperature difference
+        """
+        temp_diff = pack.heat_max - pack.heat_min
+        # stable sort, the earlier frame wins if the temperature difference is the same
+        indices = np.argsort(-temp_diff, kind='stable')[:k]
+        paths = pack.paths
+        return [(paths[i], HeatMap(pack[i])) for i in indices]
+
+    @staticmethod
+    def select_from_index_by_temperature_difference(paths, stats_index, k=1, reader=None):
+        """
+        Answer by FrameStatsIndex and only parse the k selected matrices
+        [Output] (list) of (path, HeatMap) in descending temperature difference,
+                 None if any of the paths is not indexed or outdated
+        """
+        if stats_index.missing(paths):
+            return
+
+        selected = []
+        top = stats_index.top_by_temperature_difference(k, paths)
+        for path, stats in zip(top, stats_index.get_many(top, check_fresh=False)):
+            mat = (reader or DEFAULT_READER).read(path)
+            selected.append((path, HeatMap(mat, stats.heat_min, stats.heat_max)))
+        return selected
+
+    @staticmethod
+    def select_by_temperature_difference(paths, k=1, reader=None, stats_index=None):
+        """
+        Find the top k temperature difference matrices in one pass
+        [Input] file paths or FramePack, k, stats_index: FrameStatsIndex to answer and record
+        [Output] (list) of (path, HeatMap) in descending temperature difference
+        """
+        paths, reader = Converter.frame_source(paths, reader)
+        if isinstance(reader, FramePack):
+            return Converter.select_from_pack_by_temperature_difference(reader, k)
+
+        if stats_index is None:
+            heap = Converter.heap_by_temperature_difference(paths, k, reader)
+            return Converter.sorted_by_temperature_difference(heap)
+
+        selected = Converter.select_from_index_by_temperature_difference(paths, stats_index, k, reader)
+        if selected is None:
+            heap, records = Converter.heap_by_temperature_difference(paths, k, reader, with_stats=True)
+            stats_index.update_many(records)
+            selected = Converter.sorted_by_temperature_difference(heap)
+        return selected
+
+    @staticmethod
+    def find_heatmap_by_temperature_difference(paths, reader=None):
+        """
+        Find the maximum temperature difference from matrices
+        [Input] file paths
+        [Output] (HeatMap) maximumn temperature difference heat map
+        """
+        selected = Converter.select_by_temperature_difference(paths, 1, reader)
+        if not selected:
+            return
 
+        path, max_variation = selected[0]
+        LOGGER.info('{}: heat_min={} heat_max={}'.format(
+            path, max_variation.heat_min, max_variation.heat_max
+        ))
         return max_variation
 
     @staticmethod
-    def find_rgb_by_temperature_difference(paths):
-        heatmap_max_difference = Converter.find_heatmap_by_temperature_difference(paths)
+    def find_rgb_by_temperature_difference(paths, reader=None):
+        heatmap_max_difference = Converter.find_heatmap_by_temperature_difference(paths, reader)
         rgb = heatmap_max_difference.transform_to_rgb()
         return rgb
 
@@ -123,151 +707,578 @@ class ConcurrentConverter(Converter):
     def __init__(self):
         super().__init__()
 
-    def calc_temperature_difference_by_file(self, path):
-        heatmap = self.file_to_heatmap(path)
+    def calc_temperature_difference_by_file(self, path, reader=None):
+        heatmap = self.file_to_heatmap(path, reader)
         return heatmap.heat_max - heatmap.heat_min
 
     @staticmethod
-    def cf_file_to_grayscale(paths, cb_save=None):
-        with ProcessPoolExecutor(max_workers=7) as executor:
-            cf_converter = ConcurrentConverter()
-            cf_func = cf_converter.file_to_grayscale
+    def make_save_dirs(saved_paths):
+        """
+        Create all of the output directories once before converting
+        """
+        with metrics.timer('makedirs'):
+            for directory in set(dirname(saved_path) for saved_path in saved_paths):
+                makedirs(directory, exist_ok=True)
 
-            if cb_save is not None:
-                for path, temp in zip(paths, executor.map(cf_func, paths)):
-                    saved_path = cb_save(path)
-                    if not exists(dirname(saved_path)):
-                        makedirs(dirname(saved_path))
+    @staticmethod
+    def cf_worker_save(paths, saved_paths, mode='rgb', draw_circle=False, reader=None, executor=None,
+                       manifest=None, colormap=None, normalization=None):
+        """
+        Each worker converts, encodes and writes its own frame
+        [Input] manifest: ConversionManifest to mark the saved and rejected frames
+        [Output] (list) FrameStatus of each path
+        """
+        executor = executor or get_executor()
+        ConcurrentConverter.make_save_dirs(saved_paths)
+        cf_func = partial(ConcurrentConverter.file_to_saved,
+                          mode=mode, draw_circle=draw_circle, reader=reader,
+                          colormap=colormap, normalization=normalization)
 
-                    LOGGER.info('Saved final result in {}'.format(saved_path))
-                    cv2.imwrite(saved_path, temp)
-            else:
-                return zip(paths, executor.map(cf_func, paths))
+        statuses = []
+        try:
+            for status in executor.map(cf_func, paths, saved_paths):
+                if status.saved:
+                    LOGGER.info('Saved final result in {}'.format(status.saved_path))
+                else:
+                    LOGGER.info('{} is not saved: {}'.format(status.path, status.message))
+                if manifest is not None and (status.saved or status.saved_path is None):
+                    manifest.mark(status.path, status.saved_path)
+                statuses.append(status)
+        finally:
+            if manifest is not None:
+                manifest.flush()
+        return statuses
 
     @staticmethod
-    def cf_file_to_rgb(paths, cb_save=None):
-        with ProcessPoolExecutor(max_workers=7) as executor:
-            cf_converter = ConcurrentConverter()
-            cf_func = cf_converter.file_to_rgb
+    def cf_file_to_image(paths, mode='rgb', cb_save=None, reader=None, stats_index=None,
+                         executor=None, worker_save=False, manifest=None, colormap=None,
+                         normalization=None, batch_size=BATCH_SIZE, sink=None):
+        """
+        Convert to rgb or gray image
+        [Input] file paths or FramePack, mode: 'rgb' or 'gray'
+                cb_save: callback from source path to saved path
+                stats_index: FrameStatsIndex to record the statistics of each converted frame
+                worker_save: encode and write in the worker, the parent only gets the status
+                manifest: ConversionManifest to skip the up-to-date frames and resume
+                colormap: registered name of the rgb palette, default to 'temperature'
+                normalization: Normalization with fixed range, see cf_temperature_range
+                batch_size: number of frames converted by a worker in one vectorized call
+                sink: FrameSink instead of cb_save e.g. NpyStackSink, TarShardSink, closed when done
+        [Output] list of (path, image) if cb_save is None
+                 list of FrameStatus if worker_save
+                 number of frames written if sink
+        """
+        if sink is not None:
+            with sink:
+                return ConcurrentConverter.cf_file_to_sink(
+                    paths, sink, mode, reader, executor, colormap, normalization, batch_size)
+
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        if manifest is not None and cb_save is not None:
+            paths = manifest.pending(paths, cb_save)
 
-            if cb_save is not None:
-                for path, temp in zip(paths, executor.map(cf_func, paths)):
-                    saved_path = cb_save(path)
-                    if not exists(dirname(saved_path)):
-                        makedirs(dirname(saved_path))
+        if worker_save and stats_index is not None:
+            LOGGER.warning('worker_save does not record stats_index, save in the parent instead')
+        elif cb_save is not None and worker_save:
+            saved_paths = [cb_save(path) for path in paths]
+            return ConcurrentConverter.cf_worker_save(
+                paths, saved_paths, mode, reader=reader, executor=executor, manifest=manifest,
+                colormap=colormap, normalization=normalization)
 
-                    LOGGER.info('Saved final result in {}'.format(saved_path))
+        executor = executor or get_executor()
+        cf_converter = ConcurrentConverter()
+        if stats_index is not None:
+            cf_func = partial(cf_converter.file_to_image_and_stats,
+                              mode=mode, reader=reader, colormap=colormap, normalization=normalization)
+            results = stats_index.record(zip(paths, ConcurrentConverter.iter_bounded(
+                cf_func, paths, executor=executor)))
+        else:
+            cf_func = partial(cf_converter.files_to_images,
+                              mode=mode, reader=reader, colormap=colormap, normalization=normalization)
+            chunks = [chunk for _, chunk in ConcurrentConverter.iter_chunks(paths, batch_size)]
+            results = zip(paths, chain.from_iterable(ConcurrentConverter.iter_bounded(
+                cf_func, chunks, executor=executor)))
+
+        if cb_save is None:
+            return list(results)
+
+        saved_paths = [cb_save(path) for path in paths]
+        ConcurrentConverter.make_save_dirs(saved_paths)
+        try:
+            for saved_path, (path, temp) in zip(saved_paths, results):
+                LOGGER.info('Saved final result in {}'.format(saved_path))
+                with metrics.timer('encode_write'):
                     cv2.imwrite(saved_path, temp)
-            else:
-                return zip(paths, executor.map(cf_func, paths))
+                metrics.count('frames_saved')
+                if manifest is not None:
+                    manifest.mark(path, saved_path)
+        finally:
+            if manifest is not None:
+                manifest.flush()
 
     @staticmethod
-    def cf_file_to_rgb_by_hough_circle(paths, draw_circle=False, cb_save=None):
+    def cf_iter_images(items, mode='rgb', reader=None, executor=None, colormap=None, normalization=None,
+                       batch_size=BATCH_SIZE, max_in_flight=None, ordered=True):
+        """
+        Lazy variant of cf_file_to_image, peak memory does not depend on the number of frames
+        [Input] iterable of file paths or (H, W) ndarray, or FramePack, mode: 'rgb' or 'gray'
+                max_in_flight: max number of batches submitted at once, default to 2 x max_workers
+                ordered: yield in the order of items, otherwise as the batch completed
+        [Output] generator of (path, image), the key is the running index for ndarray
+        """
+        items, reader = ConcurrentConverter.frame_source(items, reader)
+        cf_func = partial(ConcurrentConverter.items_to_images, mode=mode, reader=reader,
+                          colormap=colormap, normalization=normalization)
+
+        def keyed_chunks():
+            for start, chunk in ConcurrentConverter.iter_chunks(items, batch_size):
+                keys = [start+i if isinstance(item, np.ndarray) else item for i, item in enumerate(chunk)]
+                yield keys, chunk
+
+        batches = ConcurrentConverter.iter_bounded(
+            partial(ConcurrentConverter._keyed, cf_func), keyed_chunks(),
+            executor=executor, max_in_flight=max_in_flight, ordered=ordered)
+        for keys, images in batches:
+            for key, image in zip(keys, images):
+                yield key, image
+
+    @staticmethod
+    def _keyed(fn, keyed_chunk):
+        keys, chunk = keyed_chunk
+        return keys, fn(chunk)
+
+    @staticmethod
+    def cf_iter_pipeline(paths, mode='rgb', cb_save=None, reader=None, executor=None, colormap=None,
+                         normalization=None, batch_size=BATCH_SIZE, io_workers=4, prefetch=None,
+                         max_in_flight=None, manifest=None):
+        """
+        Stream the frames through the read, compute and write stages, see StagedPipeline
+        the disk is read and written in threads while the executor converts
+        [Input] iterable of file paths or FramePack, mode: 'rgb' or 'gray'
+                cb_save: callback from source path to saved path, None to only convert
+                batch_size: number of frames per item of the pipeline
+                io_workers, prefetch, max_in_flight: see StagedPipeline, counted in batches
+                manifest: ConversionManifest to skip the up-to-date frames and resume
+        [Output] generator of (path, image) if cb_save is None, otherwise FrameStatus
+                 in the order of paths
+        """
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        if manifest is not None and cb_save is not None:
+            paths = (path for path in paths if not manifest.is_up_to_date(path, cb_save(path)))
+
+        pipeline = StagedPipeline(
+            read=partial(ConcurrentConverter.read_raw, reader=reader),
+            compute=partial(ConcurrentConverter.raw_to_images, mode=mode, reader=reader,
+                            colormap=colormap, normalization=normalization),
+            write=partial(ConcurrentConverter.write_images, cb_save=cb_save,
+                          created=set()) if cb_save else None,
+            executor=executor, io_workers=io_workers, prefetch=prefetch, max_in_flight=max_in_flight)
+        chunks = (chunk for _, chunk in ConcurrentConverter.iter_chunks(paths, batch_size))
+
+        try:
+            for result in pipeline.run(chunks):
+                if cb_save is None:
+                    for path, image in zip(*result):
+                        yield path, image
+                    continue
+
+                for status in result:
+                    if status.saved:
+                        LOGGER.info('Saved final result in {}'.format(status.saved_path))
+                        if manifest is not None:
+                            manifest.mark(status.path, status.saved_path)
+                    yield status
+        finally:
+            if manifest is not None:
+                manifest.flush()
+
+    @staticmethod
+    def cf_file_to_outputs(paths, outputs=('rgb', 'gray', 'stats'), cb_saves=None, reader=None,
+                           executor=None, stats_index=None, colormap=None, normalization=None,
+                           detector=None, batch_size=None, max_in_flight=None):
+        """
+        Single-read conversion, each frame is read, parsed and normalized once for all of the outputs
+        instead of one pass of cf_file_to_rgb, cf_file_to_grayscale and the hough circle each
+        [Input] iterable of file paths or FramePack
+                outputs: subset of OUTPUTS
+                cb_saves: dict of 'rgb' or 'gray' to callback from source path to saved path,
+                          the image without callback is returned in FrameOutputs.images
+                stats_index: FrameStatsIndex to record the stats output
+                detector: AnchorDetector of the anchors output
+                batch_size: number of frames per task, default to ANCHOR_BATCH_SIZE with anchors
+        with anchors the file paths are sorted by natural_key so the detector tracks them in the order
+        of recording, FramePack keeps its own order
+        [Output] generator of FrameOutputs in the order of paths
+        """
+        unknown = set(outputs) - set(OUTPUTS)
+        if unknown:
+            raise ValueError('outputs should be in {}, got {}'.format(OUTPUTS, sorted(unknown)))
+        cb_saves = {output: cb for output, cb in (cb_saves or {}).items() if output in outputs}
+        batch_size = batch_size or (ANCHOR_BATCH_SIZE if 'anchors' in outputs else BATCH_SIZE)
+
+        if 'anchors' in outputs and not isinstance(paths, FramePack):
+            paths = sorted(paths, key=natural_key)
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        cf_func = partial(ConcurrentConverter.files_to_outputs, outputs=tuple(outputs), reader=reader,
+                          colormap=colormap, normalization=normalization, detector=detector)
+        created = set()
+
+        def chunks():
+            for _, chunk in ConcurrentConverter.iter_chunks(paths, batch_size):
+                saved_paths = {output: [cb(path) for path in chunk] for output, cb in cb_saves.items()}
+                directories = set(dirname(p) for batch in saved_paths.values() for p in batch) - created
+                ConcurrentConverter.make_save_dirs(join(directory, '') for directory in directories)
+                created.update(directories)
+                yield chunk, saved_paths
+
+        for results in ConcurrentConverter.iter_bounded(
+                cf_func, chunks(), executor=executor, max_in_flight=max_in_flight):
+            if stats_index is not None and 'stats' in outputs:
+                stats_index.update_many((result.path, result.stats) for result in results)
+            for result in results:
+                for output, saved_path in result.saved.items():
+                    if saved_path is not None:
+                        LOGGER.info('Saved final result in {}'.format(saved_path))
+                yield result
+
+    @staticmethod
+    def cf_file_to_grayscale(paths, cb_save=None, reader=None, stats_index=None, executor=None,
+                             worker_save=False, manifest=None, normalization=None, batch_size=BATCH_SIZE,
+                             sink=None):
+        """
+        see cf_file_to_image
+        """
+        return ConcurrentConverter.cf_file_to_image(
+            paths, 'gray', cb_save, reader, stats_index, executor, worker_save, manifest,
+            normalization=normalization, batch_size=batch_size, sink=sink)
+
+    @staticmethod
+    def cf_file_to_rgb(paths, cb_save=None, reader=None, stats_index=None, executor=None,
+                       worker_save=False, manifest=None, colormap=None, normalization=None,
+                       batch_size=BATCH_SIZE, sink=None):
+        """
+        see cf_file_to_image
+        """
+        return ConcurrentConverter.cf_file_to_image(
+            paths, 'rgb', cb_save, reader, stats_index, executor, worker_save, manifest, colormap,
+            normalization, batch_size, sink)
+
+    @staticmethod
+    def cf_file_to_rgb_by_hough_circle(paths, draw_circle=False, cb_save=None, reader=None,
+                                       executor=None, worker_save=False, manifest=None, detector=None,
+                                       prefilter=None):
         """
         1. set the path
         2. multiprocess converting by hough circle
+        worker_save: encode and write in the worker, return list of FrameStatus
+        manifest: ConversionManifest to skip the up-to-date frames and resume
+        detector: AnchorDetector to find the anchors on the 8-bit matrix and track them
+                  instead of the rgb round trip, see cf_detect_anchors
+        prefilter: FilterChain to reject the frame before any rgb work,
+                   the reject count of each stage is recorded into prefilter.counts
+        the file paths are sorted by natural_key so the anchors are tracked in the order of recording,
+        FramePack keeps its own order
         """
-        with ProcessPoolExecutor(max_workers=7) as executor:
-            convert_by = ConcurrentConverter.file_to_rgb_by_hough_circle
-            args = (paths, [draw_circle]*len(paths))
+        if not isinstance(paths, FramePack):
+            paths = sorted(paths, key=natural_key)
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        if manifest is not None and cb_save is not None:
+            paths = manifest.pending(paths, cb_save)
+        executor = executor or get_executor()
+        convert_by = partial(ConcurrentConverter.file_to_rgb_by_hough_circle, reader=reader)
+        args = (paths, [draw_circle]*len(paths))
 
-            if cb_save is None:
-                return zip(paths, executor.map(convert_by,*args))
+        def iter_heat_imgs():
+            if detector is None and prefilter is None:
+                for heat_img in ConcurrentConverter.iter_bounded(convert_by, *args, executor=executor):
+                    yield heat_img
+                return
 
-            try:
-                # convert if hough circle meet the condition
-                for frame_path, heat_img in zip(paths, executor.map(convert_by,*args)):
-                    saved_path = cb_save(frame_path)
-                    if not exists(dirname(saved_path)):
-                        makedirs(dirname(saved_path))
-
-                    if heat_img is not None:
-                        LOGGER.info('Saved {}'.format(saved_path))
-                        rgb_to_bgr = cv2.cvtColor(heat_img, cv2.COLOR_RGB2BGR)
+            cf_func = partial(ConcurrentConverter.files_to_rgb_by_hough_circle, draw_circle=draw_circle,
+                              reader=reader, detector=detector, prefilter=prefilter)
+            chunks = (chunk for _, chunk in ConcurrentConverter.iter_chunks(paths, ANCHOR_BATCH_SIZE))
+            for images, counts in ConcurrentConverter.iter_bounded(cf_func, chunks, executor=executor):
+                if prefilter is not None:
+                    prefilter.record(counts)
+                for heat_img in images:
+                    yield heat_img
+            if prefilter is not None:
+                LOGGER.info('Hough circle {}'.format(prefilter.report()))
+
+        if cb_save is None:
+            return list(zip(paths, iter_heat_imgs()))
+
+        saved_paths = [cb_save(path) for path in paths]
+        if worker_save and (detector is not None or prefilter is not None):
+            LOGGER.warning('worker_save does not track the anchors or count the rejects, '
+                           'save in the parent instead')
+        elif worker_save:
+            return ConcurrentConverter.cf_worker_save(
+                paths, saved_paths, 'hough', draw_circle, reader, executor, manifest)
+
+        try:
+            # convert if hough circle meet the condition
+            ConcurrentConverter.make_save_dirs(saved_paths)
+            heat_imgs = iter_heat_imgs()
+            for frame_path, saved_path, heat_img in zip(paths, saved_paths, heat_imgs):
+                if heat_img is not None:
+                    LOGGER.info('Saved {}'.format(saved_path))
+                    rgb_to_bgr = cv2.cvtColor(heat_img, cv2.COLOR_RGB2BGR)
+                    with metrics.timer('encode_write'):
                         cv2.imwrite(saved_path, rgb_to_bgr)
-                    else:
-                        LOGGER.info('{} is None'.format(frame_path))
+                    metrics.count('frames_saved')
+                else:
+                    LOGGER.info('{} is None'.format(frame_path))
+                    metrics.count('frames_rejected')
+                    saved_path = None
+                if manifest is not None:
+                    manifest.mark(frame_path, saved_path)
 
-                return True
-            except Exception as e:
-                LOGGER.exception('{}'.format(e))
-                return False
+            return True
+        except Exception as e:
+            LOGGER.exception('{}'.format(e))
+            return False
+        finally:
+            if manifest is not None:
+                manifest.flush()
 
     @staticmethod
-    def cf_file_to_rgb_by_temperature_difference(paths, cb_save=None):
+    def cf_detect_anchors(paths, detector=None, reader=None, executor=None, batch_size=ANCHOR_BATCH_SIZE):
         """
-        1. calc all temperature difference
-        2. convert the maximum variance matrix to rgb
-        TODO: read the target matrix once and multiprocessing at the same time
+        Find the anchors of each frame, tracked through the consecutive frames of each batch
+        [Input] iterable of file paths in the order of recording or FramePack, detector: AnchorDetector
+                batch_size: number of consecutive frames tracked by a worker
+        [Output] generator of AnchorResult in the order of paths
         """
-        file_max_difference = None
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        cf_func = partial(ConcurrentConverter.files_to_anchors, detector=detector, reader=reader)
+        chunks = (chunk for _, chunk in ConcurrentConverter.iter_chunks(paths, batch_size))
+        for anchors in ConcurrentConverter.iter_bounded(cf_func, chunks, executor=executor):
+            for anchor in anchors:
+                yield anchor
 
-        with ProcessPoolExecutor(max_workers=7) as executor:
-            cf_converter = ConcurrentConverter()
-            cf_func = cf_converter.calc_temperature_difference_by_file
+    @staticmethod
+    def cf_file_to_array(paths, mode='rgb', out_path=None, reader=None, executor=None,
+                         colormap=None, normalization=None, batch_size=BATCH_SIZE):
+        """
+        Convert all of the frames into one (N, H, W, 3) rgb or (N, H, W) gray uint8 array
+        workers write each chunk into the shared memory and only send back the start index
+        [Input] file paths or FramePack, mode: 'rgb' or 'gray'
+                out_path: write into .npy memmap instead of shared memory
+                batch_size: number of frames converted by a worker in one vectorized call
+        [Output] (ndarray) converted frames in the order of paths backed by the shared memory without copy,
+                 read-only memmap if out_path is given
+        """
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        paths = list(paths)
+        shape = (len(paths),) + tuple(ConcurrentConverter.frame_shape(paths, reader))
+        if mode != 'gray':
+            shape += (3,)
 
-            for path, temp_diff in zip(paths, executor.map(cf_func, paths)):
-                if file_max_difference is None:
-                    LOGGER.info('{} with temperature difference {}'.format(path, temp_diff))
-                    file_max_difference = (path, temp_diff)
-                elif temp_diff > file_max_difference[1]:
-                    LOGGER.info('{} with temperature difference {}'.format(path, temp_diff))
-                    file_max_difference = (path, temp_diff)
-                else:
-                    pass
+        executor = executor or get_executor()
+        buffer = SharedFrameBuffer.create(shape, np.uint8, out_path)
+        cf_func = partial(ConcurrentConverter.files_to_buffer,
+                          buffer=buffer, mode=mode, reader=reader, colormap=colormap,
+                          normalization=normalization)
+        starts, chunks = zip(*ConcurrentConverter.iter_chunks(paths, batch_size)) if paths else ((), ())
+        try:
+            for start in ConcurrentConverter.iter_bounded(cf_func, chunks, starts, executor=executor):
+                pass
+        except Exception:
+            buffer.unlink()
+            raise
+        return buffer.collect()
 
-            LOGGER.info('Final path={} temperature_diff={}'.format(
-                file_max_difference[0],
-                file_max_difference[1]
-            ))
-            rgb_max_difference = ConcurrentConverter.file_to_rgb(file_max_difference[0])
+    @staticmethod
+    def cf_file_to_sink(paths, sink, mode='rgb', reader=None, executor=None, colormap=None,
+                        normalization=None, batch_size=BATCH_SIZE, max_in_flight=None):
+        """
+        Convert and hand the frames to the sink in the order of paths e.g. VideoSink, NpyStackSink
+        the batches complete in any order, the early ones wait in ReorderBuffer,
+        a new batch is submitted only if the batches in flight and waiting are below max_in_flight
+        so memory does not depend on the number of frames
+        the workers also encode the images if sink.encoding is set e.g. TarShardSink
+        the paths already in the sink opened with append=True are skipped, so a killed job resumes
+        [Input] iterable of file paths in the order of recording or FramePack, sink: FrameSink
+                mode: 'rgb' or 'gray', max_in_flight: default to 2 x max_workers, counted in batches
+        [Output] number of frames written by this call, the sink is not closed
+        """
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        written = sink.written_paths()
+        if written:
+            LOGGER.info('Skip {} frames already in {}'.format(len(written), sink))
+            paths = (path for path in paths if path not in written)
+        executor = executor or get_executor()
+        max_in_flight = max_in_flight or 2*executor.max_workers
+        if getattr(sink, 'encoding', None):
+            cf_func = partial(ConcurrentConverter.files_to_encoded, encoding=sink.encoding, mode=mode,
+                              reader=reader, colormap=colormap, normalization=normalization)
+        else:
+            cf_func = partial(ConcurrentConverter.files_to_images, mode=mode, reader=reader,
+                              colormap=colormap, normalization=normalization)
+        chunks = (((i, chunk), chunk) for i, (_, chunk) in
+                  enumerate(ConcurrentConverter.iter_chunks(paths, batch_size)))
+        reorder = ReorderBuffer(max_in_flight)
+        futures, count, exhausted = set(), 0, False
+        try:
+            while True:
+                while not exhausted and len(futures) + len(reorder) < max_in_flight:
+                    keyed_chunk = next(chunks, None)
+                    if keyed_chunk is None:
+                        exhausted = True
+                        break
+                    futures.add(executor.submit(ConcurrentConverter._keyed, cf_func, keyed_chunk))
+                if not futures:
+                    return count
 
-            if cb_save is not None:
-                saved_path = cb_save(file_max_difference[0])
-                if not exists(dirname(saved_path)):
-                    makedirs(dirname(saved_path))
+                with metrics.timer('wait'):
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (index, chunk), images = future.result()
+                    for chunk, images in reorder.push(index, (chunk, images)):
+                        for path, image in zip(chunk, images):
+                            sink.write(path, image)
+                        count += len(chunk)
+        finally:
+            for future in futures:
+                future.cancel()
 
-                LOGGER.info('Saved final result in {}'.format(saved_path))
-                rgb_to_bgr = cv2.cvtColor(rgb_max_difference, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(saved_path, rgb_to_bgr)
+    @staticmethod
+    def cf_temperature_range(paths, reader=None, chunksize=256, stats_index=None, executor=None):
+        """
+        Dataset-wide temperature range, computed once and shared by all frames
+        [Input] file paths or FramePack, chunksize: number of paths per task
+                stats_index: FrameStatsIndex to answer without parsing
+        [Output] Normalization with the fixed range
+        """
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        if isinstance(reader, FramePack):
+            return Normalization(reader.heat_min.min(), reader.heat_max.max())
+
+        if stats_index is not None:
+            records = stats_index.get_many(paths)
+            if all(records):
+                return Normalization(min(r.heat_min for r in records), max(r.heat_max for r in records))
 
-            return rgb_max_difference
+        executor = executor or get_executor()
+        cf_func = partial(ConcurrentConverter.temperature_range, reader=reader)
+        chunks = [chunk for _, chunk in ConcurrentConverter.iter_chunks(paths, chunksize)]
+        ranges = list(executor.map(cf_func, chunks))
+        normalization = Normalization(min(r[0] for r in ranges), max(r[1] for r in ranges))
+        LOGGER.info('Temperature range of {} frames: {}'.format(len(paths), normalization))
+        return normalization
 
     @staticmethod
-    def cf_file_to_grayscale_by_temperature_difference(paths, cb_save=None):
+    def cf_temporal_projection(paths, reader=None, chunksize=256, executor=None):
+        """
+        Per-pixel max, min, mean and std over all of the frames
+        each worker projects its chunk, the parent merges the partial projections as they complete
+        [Input] iterable of file paths or FramePack, chunksize: number of paths per task
+        [Output] TemporalProjection
+        """
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        cf_func = partial(ConcurrentConverter.files_to_projection, reader=reader)
+        chunks = (chunk for _, chunk in ConcurrentConverter.iter_chunks(paths, chunksize))
+        projection = TemporalProjection()
+        for partial_projection in ConcurrentConverter.iter_bounded(
+                cf_func, chunks, executor=executor, ordered=False):
+            projection.merge(partial_projection)
+        LOGGER.info('Temporal projection of {} frames'.format(projection.count))
+        return projection
+
+    @staticmethod
+    def cf_select_by_temperature_difference(paths, k=1, reader=None, chunksize=256,
+                                            stats_index=None, executor=None):
+        """
+        Find the top k temperature difference matrices in one pass
+        each worker keeps the top k of its chunk, and only k matrices per chunk come back
+        [Input] file paths or FramePack, k, chunksize: number of paths per task
+                stats_index: FrameStatsIndex to answer without parsing and to record
+        [Output] (list) of (path, HeatMap) in descending temperature difference
         """
-        1. calc all temperature difference
+        paths, reader = ConcurrentConverter.frame_source(paths, reader)
+        if isinstance(reader, FramePack):
+            return ConcurrentConverter.select_from_pack_by_temperature_difference(reader, k)
+
+        if stats_index is not None:
+            selected = ConcurrentConverter.select_from_index_by_temperature_difference(
+                paths, stats_index, k, reader)
+            if selected is not None:
+                return selected
+
+        def merge(selected, done):
+            heaps = [selected]
+            for future in done:
+                result = future.result()
+                if stats_index is not None:
+                    result, records = result
+                    stats_index.update_many(records)
+                heaps.append(result)
+            return ConcurrentConverter.merge_heap_by_temperature_difference(heaps, k)
+
+        selected = []
+        executor = executor or get_executor()
+        cf_func = partial(ConcurrentConverter.heap_by_temperature_difference,
+                          k=k, reader=reader, with_stats=stats_index is not None)
+        futures = set()
+
+        # bounded in-flight chunks, merge the finished one before submit the next
+        for start, chunk in ConcurrentConverter.iter_chunks(paths, chunksize):
+            if len(futures) >= 2*executor.max_workers:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                selected = merge(selected, done)
+            futures.add(executor.submit(cf_func, chunk, start=start))
+
+        selected = merge(selected, futures)
+        return ConcurrentConverter.sorted_by_temperature_difference(selected)
+
+    @staticmethod
+    def cf_file_to_rgb_by_temperature_difference(paths, cb_save=None, reader=None,
+                                                 stats_index=None, executor=None, colormap=None):
+        """
+        1. calc all temperature difference and keep the maximum variance matrix
         2. convert the maximum variance matrix to rgb
-        TODO: read the target matrix once and multiprocessing at the same time
         """
-        file_max_difference = None
+        selected = ConcurrentConverter.cf_select_by_temperature_difference(
+            paths, 1, reader, stats_index=stats_index, executor=executor)
+        path, heat_map = selected[0]
+        LOGGER.info('Final path={} temperature_diff={}'.format(
+            path, heat_map.heat_max - heat_map.heat_min
+        ))
+        rgb_max_difference = heat_map.transform_to_rgb(colormap=colormap)
 
-        with ProcessPoolExecutor(max_workers=7) as executor:
-            cf_converter = ConcurrentConverter()
-            cf_func = cf_converter.calc_temperature_difference_by_file
+        if cb_save is not None:
+            saved_path = cb_save(path)
+            if not exists(dirname(saved_path)):
+                makedirs(dirname(saved_path))
 
-            for path, temp_diff in zip(paths, executor.map(cf_func, paths)):
-                if file_max_difference is None:
-                    LOGGER.info('{} with temperature difference {}'.format(path, temp_diff))
-                    file_max_difference = (path, temp_diff)
-                elif temp_diff > file_max_difference[1]:
-                    LOGGER.info('{} with temperature difference {}'.format(path, temp_diff))
-                    file_max_difference = (path, temp_diff)
-                else:
-                    pass
+            LOGGER.info('Saved final result in {}'.format(saved_path))
+            rgb_to_bgr = cv2.cvtColor(rgb_max_difference, cv2.COLOR_RGB2BGR)
+            cv2.imwrite(saved_path, rgb_to_bgr)
 
-            LOGGER.info('Final path={} temperature_diff={}'.format(
-                file_max_difference[0],
-                file_max_difference[1]
-            ))
-            gray_max_difference = ConcurrentConverter.file_to_grayscale(file_max_difference[0])
+        return rgb_max_difference
 
-            if cb_save is not None:
-                saved_path = cb_save(file_max_difference[0])
-                if not exists(dirname(saved_path)):
-                    makedirs(dirname(saved_path))
+    @staticmethod
+    def cf_file_to_grayscale_by_temperature_difference(paths, cb_save=None, reader=None,
+                                                       stats_index=None, executor=None):
+        """
+        1. calc all temperature difference and keep the maximum variance matrix
+        2. convert the maximum variance matrix to grayscale
+        """
+        selected = ConcurrentConverter.cf_select_by_temperature_difference(
+            paths, 1, reader, stats_index=stats_index, executor=executor)
+        path, heat_map = selected[0]
+        LOGGER.info('Final path={} temperature_diff={}'.format(
+            path, heat_map.heat_max - heat_map.heat_min
+        ))
+        gray_max_difference = heat_map.transform_to_gray()
 
-                LOGGER.info('Saved final result in {}'.format(saved_path))
-                cv2.imwrite(saved_path, gray_max_difference)
+        if cb_save is not None:
+            saved_path = cb_save(path)
+            if not exists(dirname(saved_path)):
+                makedirs(dirname(saved_path))
+
+            LOGGER.info('Saved final result in {}'.format(saved_path))
+            cv2.imwrite(saved_path, gray_max_difference)
 
-            return gray_max_difference
+        return gray_max_difference
@@ -0,0 +1,152 @@
+"""
+executor.py
+    [class] SerialExecutor: run the task in the caller, for debugging and tiny jobs
+    [class] ConverterExecutor: long-lived executor shared by ConcurrentConverter
+    [func] get_executor / set_executor: the shared default executor
+"""
+import atexit
+import logging
+import os
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing import resource_tracker
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+BACKENDS = ('process', 'thread', 'serial')
+
+class SerialExecutor(Executor):
+    """
+    Executor run each task immediately in the caller
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+class ConverterExecutor(object):
+    """
+    Create the pool once and reuse it across calls
+    so the process startup and NumPy/OpenCV import only cost once
+    if the metrics are enabled, the process worker sends back its metrics with each result
+
+    [Input]
+        backend: 'process', 'thread' or 'serial'
+        max_workers: number of workers, default to CPU count
+        chunksize: number of tasks sent to a process worker at once by map()
+    """
+    def __init__(self, backend='process', max_workers=None, chunksize=16):
+        super().__init__()
+        if backend not in BACKENDS:
+            raise ValueError('backend should be one of {}, got {}'.format(BACKENDS, backend))
+        self.backend = backend
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self._executor = None
+
+    def __repr__(self):
+        return '{}(backend={}, max_workers={}, chunksize={})'.format(
+            self.__class__.__name__, self.backend, self.max_workers, self.chunksize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.backend == 'process':
+                # start the resource tracker first so the workers share it with the parent,
+                # otherwise each worker tracks the attached SharedFrameBuffer and unlinks it on exit
+                resource_tracker.ensure_running()
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            elif self.backend == 'thread':
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = SerialExecutor()
+            LOGGER.info('Start {}'.format(self))
+        return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        if self.backend != 'process' or not metrics.is_enabled():
+            return self.executor.submit(fn, *args, **kwargs)
+        return self._submit_collected(fn, *args, **kwargs)
+
+    def _submit_collected(self, fn, *args, **kwargs):
+        """
+        Run fn in the worker with the metrics enabled, merge the worker metrics when it is done
+        the returned Future has the result of fn, cancelling it cancels the task
+        """
+        task = self.executor.submit(metrics.collect, fn, *args, **kwargs)
+        future = Future()
+
+        def on_task_done(task):
+            if future.cancelled():
+                return
+            try:
+                result, snapshot = task.result()
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            metrics.METRICS.merge(snapshot)
+            future.set_result(result)
+
+        future.add_done_callback(lambda f: f.cancelled() and task.cancel())
+        task.add_done_callback(on_task_done)
+        return future
+
+    def map(self, fn, *iterables, chunksize=None):
+        """
+        Same as Executor.map, tasks are sent in chunks to the process workers
+        """
+        chunksize = chunksize or self.chunksize
+        if self.backend != 'process':
+            return self.executor.map(fn, *iterables)
+        if metrics.is_enabled():
+            return self._merged(self.executor.map(partial(metrics.collect, fn), *iterables, chunksize=chunksize))
+        return self.executor.map(fn, *iterables, chunksize=chunksize)
+
+    @staticmethod
+    def _merged(collected):
+        for result, snapshot in collected:
+            metrics.METRICS.merge(snapshot)
+            yield result
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+            LOGGER.info('Shutdown {}'.format(self))
+
+_DEFAULT_EXECUTOR = None
+
+def get_executor():
+    """
+    Return the shared ConverterExecutor, create it with default setting at first call
+    """
+    global _DEFAULT_EXECUTOR
+    if _DEFAULT_EXECUTOR is None:
+        _DEFAULT_EXECUTOR = ConverterExecutor()
+    return _DEFAULT_EXECUTOR
+
+def set_executor(backend='process', max_workers=None, chunksize=16):
+    """
+    Replace the shared ConverterExecutor, the previous pool is shutdown
+    """
+    global _DEFAULT_EXECUTOR
+    if _DEFAULT_EXECUTOR is not None:
+        _DEFAULT_EXECUTOR.shutdown()
+    _DEFAULT_EXECUTOR = ConverterExecutor(backend, max_workers, chunksize)
+    return _DEFAULT_EXECUTOR
+
+@atexit.register
+def _shutdown_default_executor():
+    if _DEFAULT_EXECUTOR is not None:
+        _DEFAULT_EXECUTOR.shutdown()
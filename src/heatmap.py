@@ -1,11 +1,16 @@
 """
 heatmap.py
     [class] HeatMap: define a heat map for transformation and operation
+    [class] HeatMapStack: (N, H, W) heat maps transformed in one vectorized call
 """
 import logging
 
+import numpy as np
+
+from . import metrics
 from .color import ColorTransformation as c_trans
-from .color import Palette
+from .color import LUT_SIZE, Normalization, Palette, get_colormap
+from .stats import calc_frame_stats
 
 
 LOGGER = logging.getLogger(__name__)
@@ -14,45 +19,138 @@ class HeatMap(object):
     """
     Input and matrix in float and out put as image
 
-    [Input] ndarray
+    [Input] ndarray, heat_min, heat_max: known range of the frame e.g. from FrameStats
+            normalization: Normalization with fixed range, skip the min/max scan until heat_min/heat_max is read
     [Output] ndarray
+    heat_min and heat_max are always of the frame, the scale is taken from self.normalization
     """
-    def __init__(self, mat):
-        self.mat = mat
-        self.mat_row, self.mat_col = len(mat), len(mat[0])
-        self.palette = Palette()
-        self._heat_min = min(min(t for t in row) for row in mat)
-        self._heat_max = max(max(t for t in row) for row in mat)
+    def __init__(self, mat, heat_min=None, heat_max=None, colormap='temperature', normalization=None):
+        self.mat = np.asarray(mat)
+        self.mat_row, self.mat_col = self.mat.shape[:2]
+        self.palette = Palette(colormap)
+        self._heat_min = heat_min
+        self._heat_max = heat_max
+        if normalization is not None and normalization.is_fixed:
+            self.normalization = normalization
+        else:
+            self.normalization = Normalization(self.heat_min, self.heat_max)
 
     @property
     def heat_min(self):
+        if self._heat_min is None:
+            with metrics.timer('minmax'):
+                self._heat_min = self.mat.min()
         return self._heat_min
 
     @property
     def heat_max(self):
+        if self._heat_max is None:
+            with metrics.timer('minmax'):
+                self._heat_max = self.mat.max()
         return self._heat_max
 
-    def transform_to_rgb(self):
-        rgb_mat = []
-        for row in self.mat:
-            rgb_row = [
-                list(c_trans.color_transformation(
-                    col, self._heat_min, self._heat_max, self.palette.temperature_rgb))
-                for col in row
-            ]
-            rgb_mat.append(rgb_row)
-        return rgb_mat
-
-    def transform_to_gray(self):
-        gray_mat = []
-        # print(list(c_trans.color_transformation(31, 25, 32, self.palette.temperature_rgb)))
-        # print([c_trans.gray_transformation(31, 25, 32, self.palette.grayscale)])
-        for row in self.mat:
-            gray_row = [
-                c_trans.gray_transformation(
-                    col, self._heat_min, self._heat_max, self.palette.grayscale)
-                for col in row
-            ]
-            gray_mat.append(gray_row)
-        return gray_mat
+    def stats(self):
+        """
+        [Output] FrameStats of min, max, mean, std and percentiles
+        """
+        return calc_frame_stats(self.mat)
+
+    def transform_to_rgb(self, out=None, colormap=None, interpolate=True):
+        """
+        [Input] out: preallocated uint8 array, colormap: registered name, default to self.palette
+                interpolate: False to map the quantized index through the lookup table directly
+        [Output] (ndarray) uint8 rgb image in shape (H, W, 3)
+        """
+        colormap = get_colormap(colormap or self.palette.colormap)
+        scale = self.normalization.scale(LUT_SIZE-1)
+        with metrics.timer('colorize_rgb'):
+            if not interpolate:
+                index = c_trans.quantize_transformation_array(
+                    self.mat, self.normalization.heat_min, self.normalization.heat_max, scale=scale)
+                return c_trans.lut_transformation_array(index, colormap, out=out)
+
+            return c_trans.color_transformation_array(
+                self.mat, self.normalization.heat_min, self.normalization.heat_max, colormap, out=out,
+                scale=scale)
+
+    def transform_to_gray(self, out=None):
+        """
+        [Output] (ndarray) uint8 gray image in shape (H, W)
+        """
+        with metrics.timer('colorize_gray'):
+            return c_trans.gray_transformation_array(
+                self.mat, self.normalization.heat_min, self.normalization.heat_max, self.palette.grayscale,
+                out=out, scale=self.normalization.scale(LUT_SIZE-1))
+
+class HeatMapStack(object):
+    """
+    Stack of matrices in float and out put as images in one vectorized call
+    the same pixels as converting each frame by HeatMap
+
+    [Input] (ndarray) in shape (N, H, W), normalization: Normalization, default to per-frame range
+    [Output] (ndarray) in shape (N, H, W, 3) or (N, H, W)
+    """
+    def __init__(self, mats, colormap='temperature', normalization=None):
+        self.mats = np.asarray(mats)
+        if self.mats.ndim != 3:
+            raise ValueError('stack should be in shape (N, H, W), got {}'.format(self.mats.shape))
+        self.palette = Palette(colormap)
+        self.normalization = normalization or Normalization()
+
+        # (N, 1, 1) per-frame range, or the scalar fixed range
+        with metrics.timer('minmax'):
+            self._range_min, self._range_max = self.normalization.range_of(self.mats, axis=(-2, -1))
+        if self.normalization.is_fixed:
+            self._scale = self.normalization.scale(LUT_SIZE-1)
+        else:
+            self._scale = Normalization.scale_of(self._range_min, self._range_max, LUT_SIZE-1)
+
+    def __len__(self):
+        return len(self.mats)
+
+    @property
+    def heat_min(self):
+        """(ndarray) min of each frame, scanned on read with the fixed range"""
+        if self.normalization.is_fixed:
+            return self.mats.min(axis=(-2, -1))
+        return self._range_min.ravel()
+
+    @property
+    def heat_max(self):
+        """(ndarray) max of each frame, scanned on read with the fixed range"""
+        if self.normalization.is_fixed:
+            return self.mats.max(axis=(-2, -1))
+        return self._range_max.ravel()
+
+    def _frame_args(self):
+        """(mat, scale min, scale max, scale) of each frame"""
+        heat_min = np.broadcast_to(self._range_min, (len(self), 1, 1))
+        heat_max = np.broadcast_to(self._range_max, (len(self), 1, 1))
+        scale = np.broadcast_to(self._scale, (len(self), 1, 1))
+        return zip(self.mats, heat_min, heat_max, scale)
+
+    def transform_to_rgb(self, out=None, colormap=None):
+        """
+        [Output] (ndarray) uint8 rgb images in shape (N, H, W, 3)
+        """
+        colormap = get_colormap(colormap or self.palette.colormap)
+        if out is None:
+            out = np.empty(self.mats.shape + (3,), dtype=np.uint8)
+
+        # one frame at a time, the float64 intermediates of the whole stack do not fit in cache
+        for i, (mat, heat_min, heat_max, scale) in enumerate(self._frame_args()):
+            with metrics.timer('colorize_rgb'):
+                c_trans.color_transformation_array(mat, heat_min, heat_max, colormap, out=out[i], scale=scale)
+        return out
 
+    def transform_to_gray(self, out=None):
+        """
+        [Output] (ndarray) uint8 gray images in shape (N, H, W)
+        """
+        if out is None:
+            out = np.empty(self.mats.shape, dtype=np.uint8)
+        for i, (mat, heat_min, heat_max, scale) in enumerate(self._frame_args()):
+            with metrics.timer('colorize_gray'):
+                c_trans.gray_transformation_array(
+                    mat, heat_min, heat_max, self.palette.grayscale, out=out[i], scale=scale)
+        return out
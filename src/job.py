@@ -0,0 +1,104 @@
+"""
+job.py
+    [class] JobEvent: progress, done, cancelled or error of a background conversion
+    [class] ConversionJob: run a conversion generator in a background thread and report by a queue
+"""
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+LOGGER = logging.getLogger(__name__)
+
+# kind: 'progress', 'done', 'cancelled' or 'error', done: frames finished, failed: frames not saved
+JobEvent = namedtuple('JobEvent', ['kind', 'done', 'failed', 'total', 'elapsed', 'message'])
+
+class ConversionJob(object):
+    """
+    Consume the generator of FrameStatus e.g. wrapper.cf_iter_convert in a background thread
+    the results pushed back by the workers become JobEvent in the queue, the GUI drains it
+    on its own timer with poll(), so the GUI thread never blocks and never touches the disk
+
+    [Input]
+        make_statuses: callable without argument returning the generator of FrameStatus
+        total: number of frames for the ETA, None if unknown
+        progress_every: number of frames between the progress events
+    """
+    def __init__(self, make_statuses, total=None, progress_every=1):
+        super().__init__()
+        self.make_statuses = make_statuses
+        self.total = total
+        self.progress_every = progress_every
+        self.events = queue.Queue()
+        self._cancel = threading.Event()
+        self._thread = None
+        self._start = None
+
+    def __repr__(self):
+        return '{}(total={}, running={})'.format(self.__class__.__name__, self.total, self.is_running)
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='conversion-job', daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """stop after the frame in hand, the in-flight tasks are cancelled"""
+        self._cancel.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _event(self, kind, done, failed, message=''):
+        self.events.put(JobEvent(kind, done, failed, self.total, time.perf_counter() - self._start, message))
+
+    def _run(self):
+        done = failed = 0
+        statuses = None
+        try:
+            statuses = self.make_statuses()
+            for status in statuses:
+                done += 1
+                if not status.saved and status.saved_path is not None:
+                    failed += 1
+                if self._cancel.is_set():
+                    self._event('cancelled', done, failed)
+                    return
+                if done % self.progress_every == 0:
+                    self._event('progress', done, failed)
+            self._event('done', done, failed)
+        except Exception as e:
+            LOGGER.exception('{}'.format(e))
+            self._event('error', done, failed, '{}'.format(e))
+        finally:
+            # close the generator here so the pipeline cancels its in-flight tasks
+            if statuses is not None and hasattr(statuses, 'close'):
+                statuses.close()
+
+    def poll(self):
+        """
+        [Output] (list) JobEvent queued since the last poll, never blocks
+        """
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    @staticmethod
+    def throughput(event):
+        """
+        [Output] (frames per second, seconds left or None if unknown)
+        """
+        rate = event.done / event.elapsed if event.elapsed > 0 else 0.0
+        if not rate or event.total is None:
+            return rate, None
+        return rate, max(event.total - event.done, 0) / rate
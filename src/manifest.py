@@ -0,0 +1,153 @@
+"""
+manifest.py
+    [class] ConversionManifest: record the converted frames to resume and skip up-to-date frames
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from os import sep
+from os.path import abspath, exists, getmtime
+
+LOGGER = logging.getLogger(__name__)
+
+def source_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+class ConversionManifest(object):
+    """
+    Record source signature, conversion parameters and saved path of each converted frame
+    the manifest is an append-only JSON-lines log, every flush_interval seconds and at the end
+    only the entries marked since the last flush are appended, so an interrupted job resumes where it stopped
+    the later line of the same frame wins, the log is compacted on open once most of it is stale
+
+    [Input]
+        manifest_path: .jsonl file, see ConversionManifest.path_of(save_directory)
+        params: (dict) conversion parameters e.g. mode, colormap, hough setting
+        flush_interval: seconds between two writes
+    """
+    # compact on open once the log has this many lines per live entry
+    COMPACT_RATIO = 2
+
+    def __init__(self, manifest_path, params=None, flush_interval=5.0):
+        super().__init__()
+        self.manifest_path = abspath(manifest_path)
+        self.params = params or {}
+        self.params_key = hashlib.sha1(
+            json.dumps(self.params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        self.flush_interval = flush_interval
+        self._unsaved = []
+        self._flushed_at = time.time()
+        self.entries = {}
+
+        if exists(self.manifest_path):
+            lines = self._load()
+            if lines > self.COMPACT_RATIO * len(self.entries):
+                self.compact()
+
+    def __repr__(self):
+        return '{}({}, params={})'.format(self.__class__.__name__, self.manifest_path, self.params)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def path_of(save_directory):
+        """the manifest is saved next to the output directory, not inside it"""
+        return abspath(save_directory).rstrip(sep) + '.manifest.jsonl'
+
+    @staticmethod
+    def for_directory(save_directory, params=None):
+        return ConversionManifest(ConversionManifest.path_of(save_directory), params)
+
+    def _load(self):
+        """
+        read the log, the partial last line of a killed job is cut off so the next append starts clean
+        [Output] number of lines read
+        """
+        with open(self.manifest_path, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            LOGGER.warning('{}: drop the partial last entry'.format(self.manifest_path))
+            with open(self.manifest_path, 'r+b') as f:
+                f.truncate(end)
+
+        lines = data[:end].splitlines()
+        for line in lines:
+            entry = json.loads(line.decode('utf-8'))
+            self.entries[entry.pop('path')] = entry
+        return len(lines)
+
+    @staticmethod
+    def _line(path, entry):
+        return json.dumps(dict(entry, path=path), default=str) + '\n'
+
+    def compact(self):
+        """
+        rewrite the log with one line per frame into a temp file and rename
+        """
+        temp_path = '{}.{}.tmp'.format(self.manifest_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.writelines(self._line(path, entry) for path, entry in self.entries.items())
+        os.replace(temp_path, self.manifest_path)
+        self._unsaved = []
+
+    def is_up_to_date(self, path, saved_path):
+        """
+        up to date if converted with the same parameters from the same source,
+        and the output exists and is newer than the source
+        the frame rejected by the converter e.g. hough circle has no output
+        """
+        entry = self.entries.get(abspath(path))
+        if entry is None or entry['params'] != self.params_key:
+            return False
+        try:
+            if entry['source'] != source_signature(path):
+                return False
+            if entry['saved_path'] is None:
+                return True
+            return exists(saved_path) and getmtime(saved_path) >= getmtime(path)
+        except OSError:
+            return False
+
+    def pending(self, paths, cb_save):
+        """
+        [Input] paths, cb_save: callback from source path to saved path
+        [Output] (list) paths need to be converted
+        """
+        pending_paths = [path for path in paths if not self.is_up_to_date(path, cb_save(path))]
+        LOGGER.info('{} frames to convert, {} frames up to date'.format(
+            len(pending_paths), len(paths) - len(pending_paths)))
+        return pending_paths
+
+    def mark(self, path, saved_path):
+        """
+        [Input] path, saved_path: None if the converter rejected the frame
+        """
+        try:
+            signature = source_signature(path)
+        except OSError:
+            return
+
+        path = abspath(path)
+        self.entries[path] = {
+            'source': signature,
+            'params': self.params_key,
+            'saved_path': saved_path
+        }
+        self._unsaved.append(path)
+        if time.time() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        append the entries marked since the last flush, the cost does not grow with the manifest
+        """
+        if self._unsaved:
+            with open(self.manifest_path, 'a') as f:
+                f.writelines(self._line(path, self.entries[path]) for path in self._unsaved)
+            self._unsaved = []
+        self._flushed_at = time.time()
@@ -0,0 +1,272 @@
+"""
+metrics.py
+    [class] Histogram: count, sum, min, max and log2 buckets of the observed values
+    [class] Metrics: per-stage timers, counters and histograms, aggregated across the workers
+    [class] PeriodicReporter: log the snapshot every interval seconds
+    [func] enable / disable / timer / count / observe: the process-wide METRICS, no-op if disabled
+
+    with metrics.timer('parse'):
+        ...
+"""
+import logging
+import threading
+import time
+from math import frexp
+
+LOGGER = logging.getLogger(__name__)
+
+# bucket k counts the value in [UNIT * 2**(k-1), UNIT * 2**k), bucket 0 is below UNIT
+UNIT = 1e-6
+BUCKETS = 40
+
+class Histogram(object):
+    """
+    Mergeable histogram of non-negative values e.g. seconds of a stage
+    """
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0]*BUCKETS
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        bucket = frexp(value / UNIT)[1] if value >= UNIT else 0
+        self.buckets[min(bucket, BUCKETS-1)] += 1
+
+    def merge(self, other):
+        """
+        [Input] Histogram or its state from to_dict()
+        """
+        if isinstance(other, dict):
+            other = Histogram.from_dict(other)
+        self.count += other.count
+        self.total += other.total
+        for attr, pick in (('min', min), ('max', max)):
+            values = [v for v in (getattr(self, attr), getattr(other, attr)) if v is not None]
+            setattr(self, attr, pick(values) if values else None)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def quantile(self, q):
+        """upper bound of the bucket containing the q quantile"""
+        if not self.count:
+            return None
+        target, cumulative = q * self.count, 0
+        for bucket, n in enumerate(self.buckets):
+            cumulative += n
+            if cumulative >= target:
+                return min(UNIT * 2**bucket, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max,
+                'buckets': list(self.buckets)}
+
+    @staticmethod
+    def from_dict(state):
+        histogram = Histogram()
+        histogram.count, histogram.total = state['count'], state['total']
+        histogram.min, histogram.max = state['min'], state['max']
+        histogram.buckets = list(state['buckets'])
+        return histogram
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95)
+        }
+
+class _Timer(object):
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class Metrics(object):
+    """
+    Timers are histograms of seconds, counters are integers, both keyed by stage name
+    the worker process sends its snapshot back with each task, see ConverterExecutor,
+    and the parent merges it, so the summary covers the whole job
+    disabled by default, every call returns at once
+    """
+    def __init__(self):
+        super().__init__()
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def __repr__(self):
+        return '{}(enabled={}, counters={}, histograms={})'.format(
+            self.__class__.__name__, self.enabled, len(self.counters), len(self.histograms))
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        """
+        [Output] (dict) picklable state of counters and histograms
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: h.to_dict() for name, h in self.histograms.items()}
+            }
+
+    def merge(self, snapshot):
+        """
+        [Input] snapshot() from another process, None is ignored
+        """
+        if not snapshot:
+            return
+        with self._lock:
+            for name, n in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, state in snapshot['histograms'].items():
+                self.histograms.setdefault(name, Histogram()).merge(state)
+
+    def summary(self):
+        """
+        [Output] (dict) counters and count, total, mean, min, max, p50, p95 of each timer
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {name: h.summary() for name, h in sorted(self.histograms.items())}
+            }
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ['{}: {}'.format(name, n) for name, n in sorted(summary['counters'].items())]
+        for name, timer in summary['timers'].items():
+            lines.append('{}: count={} total={:.3f}s mean={:.3f}ms p95={:.3f}ms'.format(
+                name, timer['count'], timer['total'], 1e3 * timer['mean'], 1e3 * timer['p95']))
+        return '\n'.join(lines)
+
+METRICS = Metrics()
+
+def enable():
+    METRICS.enabled = True
+
+def disable():
+    METRICS.enabled = False
+
+def is_enabled():
+    return METRICS.enabled
+
+def timer(name):
+    """context manager to time the stage, no-op if disabled"""
+    if not METRICS.enabled:
+        return _NULL_TIMER
+    return _Timer(METRICS, name)
+
+def count(name, n=1):
+    if METRICS.enabled:
+        METRICS.count(name, n)
+
+def observe(name, value):
+    if METRICS.enabled:
+        METRICS.observe(name, value)
+
+def collect(fn, *args, **kwargs):
+    """
+    Run fn in the worker process with the metrics enabled
+    [Output] (result of fn, snapshot of the metrics recorded by fn)
+    """
+    METRICS.reset()
+    METRICS.enabled = True
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        METRICS.enabled = False
+    return result, METRICS.snapshot()
+
+class PeriodicReporter(object):
+    """
+    Log or hand over the snapshot every interval seconds until stopped
+    [Input] interval: seconds, sink: callable of Metrics.summary(), default to LOGGER.info
+    """
+    def __init__(self, interval=10.0, sink=None, metrics=None):
+        super().__init__()
+        self.interval = interval
+        self.sink = sink or (lambda summary: LOGGER.info('metrics {}'.format(summary)))
+        self.metrics = metrics or METRICS
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop and report the final snapshot"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sink(self.metrics.summary())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sink(self.metrics.summary())
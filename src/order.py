@@ -0,0 +1,10 @@
+"""
+order.py
+    [func] natural_key: sort key of the frames in the order of recording
+"""
+import re
+from os.path import basename
+
+def natural_key(path):
+    """sort 2.txt before 10.txt, so the frames are in the order of recording"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', basename(path))]
@@ -0,0 +1,165 @@
+"""
+pack.py
+    [class] FramePack: pack a recording folder into a single memory-mapped frame stack
+
+    python -m src.pack <folder> <pack.npy> [--dtype float16]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from os import listdir
+from os.path import abspath, basename, join, splitext
+
+import numpy as np
+
+from .order import natural_key
+from .reader import DEFAULT_READER, ThermaCAMReader
+
+LOGGER = logging.getLogger(__name__)
+
+# the opened pack per process, the worker unpickle the pack by path only
+_OPENED_PACKS = {}
+
+class FramePack(object):
+    """
+    Contiguous (N, H, W) frame stack in one .npy
+    with the sidecar .json index of original filenames and per-frame min/max
+
+    Use it wherever a reader is accepted, or as the source instead of a path list
+    frame k is a slice of the memory-mapped stack without any per-file syscall
+    """
+    def __init__(self, pack_path):
+        super().__init__()
+        self.pack_path = abspath(pack_path)
+        self.index_path = FramePack.index_path_of(self.pack_path)
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+
+        self.source_dir = index['source_dir']
+        self.filenames = index['filenames']
+        self.heat_min = np.asarray(index['heat_min'])
+        self.heat_max = np.asarray(index['heat_max'])
+        self._lookup = {name: i for i, name in enumerate(self.filenames)}
+        self._frames = None
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.pack_path)
+
+    def __reduce__(self):
+        return (FramePack.open, (self.pack_path,))
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, k):
+        return self.frames[k]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    @staticmethod
+    def index_path_of(pack_path):
+        return splitext(pack_path)[0] + '.json'
+
+    @staticmethod
+    def open(pack_path):
+        """open the pack once per process"""
+        pack_path = abspath(pack_path)
+        if pack_path not in _OPENED_PACKS:
+            _OPENED_PACKS[pack_path] = FramePack(pack_path)
+        return _OPENED_PACKS[pack_path]
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = np.load(self.pack_path, mmap_mode='r')
+        return self._frames
+
+    @property
+    def paths(self):
+        """original file paths, the key to read the frame"""
+        return [join(self.source_dir, name) for name in self.filenames]
+
+    def index_of(self, file_path):
+        if isinstance(file_path, (int, np.integer)):
+            return int(file_path)
+        return self._lookup[basename(file_path)]
+
+    def read(self, file_path, out=None):
+        """
+        [Input] original file path or frame index, out: preallocated ndarray
+        [Output] (ndarray) read-only memory-mapped matrix
+        """
+        mat = self.frames[self.index_of(file_path)]
+        if out is None:
+            return mat
+        out[...] = mat
+        return out
+
+    @staticmethod
+    def pack(folder, pack_path, reader=None, dtype=np.float32, ext='.txt'):
+        """
+        Parse all of the frames under the folder into one (N, H, W) .npy
+        [Input] folder path, pack path, reader: ThermaCAMReader, dtype: float32 or float16
+        [Output] FramePack
+        """
+        reader = reader or DEFAULT_READER
+        folder = abspath(folder)
+        filenames = sorted((name for name in listdir(folder) if name.endswith(ext)), key=natural_key)
+        if not filenames:
+            raise ValueError('No {} file under {}'.format(ext, folder))
+
+        first_frame = reader.read(join(folder, filenames[0]))
+        shape = (len(filenames),) + first_frame.shape
+        temp_path = '{}.{}.tmp'.format(pack_path, os.getpid())
+        frames = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=shape)
+        heat_min, heat_max = [], []
+
+        for i, name in enumerate(filenames):
+            mat = first_frame if i == 0 else reader.read(join(folder, name))
+            frames[i] = mat
+            heat_min.append(float(frames[i].min()))
+            heat_max.append(float(frames[i].max()))
+            LOGGER.debug('Pack {} as frame {}'.format(name, i))
+
+        frames.flush()
+        del frames
+        os.replace(temp_path, pack_path)
+
+        index = {
+            'source_dir': folder,
+            'filenames': filenames,
+            'heat_min': heat_min,
+            'heat_max': heat_max
+        }
+        index_path = FramePack.index_path_of(abspath(pack_path))
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+        # reload if the pack was opened in this process before
+        _OPENED_PACKS.pop(abspath(pack_path), None)
+        LOGGER.info('Packed {} frames from {} into {}'.format(len(filenames), folder, pack_path))
+        return FramePack.open(pack_path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack ThermaCAM .txt folder into single frame stack')
+    parser.add_argument('folder', help='folder of ThermaCAM .txt')
+    parser.add_argument('pack_path', help='output .npy path, index is saved next to it as .json')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--header-rows', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    reader = ThermaCAMReader(header_rows=args.header_rows)
+    FramePack.pack(args.folder, args.pack_path, reader=reader, dtype=args.dtype)
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(filename)12s:L%(lineno)3s [%(levelname)8s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        stream=sys.stdout
+    )
+    main()
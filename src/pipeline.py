@@ -0,0 +1,97 @@
+"""
+pipeline.py
+    [class] StagedPipeline: read, compute and write stages overlapped with bounded queues
+"""
+import logging
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .executor import get_executor
+
+LOGGER = logging.getLogger(__name__)
+
+class StagedPipeline(object):
+    """
+    Streaming pipeline of three stages, so the disk and the CPU are busy at the same time
+        read: prefetch in the I/O threads
+        compute: in the shared ConverterExecutor e.g. process pool
+        write: in the I/O threads
+    each stage holds a bounded number of items, the upstream stage waits for the downstream
+    one to catch up (backpressure), memory is bounded no matter how many items
+
+    [Input]
+        read, compute, write: callable of one item, write can be None
+        executor: ConverterExecutor for compute, default to get_executor()
+        io_workers: number of threads for read and write
+        prefetch: max number of items read ahead, default to max_in_flight
+        max_in_flight: max number of items in compute, default to 2 x max_workers
+        max_pending_writes: max number of items in write, default to 2 x io_workers
+    """
+    def __init__(self, read, compute, write=None, executor=None, io_workers=4, prefetch=None,
+                 max_in_flight=None, max_pending_writes=None):
+        super().__init__()
+        self.read = read
+        self.compute = compute
+        self.write = write
+        self.executor = executor or get_executor()
+        self.io_workers = io_workers
+        self.max_in_flight = max_in_flight or 2*self.executor.max_workers
+        self.prefetch = prefetch or self.max_in_flight
+        self.max_pending_writes = max_pending_writes or 2*io_workers
+
+    def __repr__(self):
+        return '{}(io_workers={}, prefetch={}, max_in_flight={}, max_pending_writes={})'.format(
+            self.__class__.__name__, self.io_workers, self.prefetch, self.max_in_flight,
+            self.max_pending_writes)
+
+    def run(self, items):
+        """
+        [Input] iterable of items, consumed lazily
+        [Output] generator of the result of write, or compute if no write, in the order of items
+        """
+        items = iter(items)
+        reads, computes, writes = deque(), deque(), deque()
+        exhausted = False
+
+        with ThreadPoolExecutor(max_workers=self.io_workers) as io_executor:
+            try:
+                while True:
+                    # read ahead
+                    while not exhausted and len(reads) < self.prefetch:
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        reads.append(io_executor.submit(self.read, item))
+
+                    # only the head of each stage can move on, the order is kept
+                    while reads and reads[0].done() and len(computes) < self.max_in_flight:
+                        computes.append(self.executor.submit(self.compute, reads.popleft().result()))
+
+                    while computes and computes[0].done():
+                        if self.write is None:
+                            yield computes.popleft().result()
+                        elif len(writes) < self.max_pending_writes:
+                            writes.append(io_executor.submit(self.write, computes.popleft().result()))
+                        else:
+                            break
+
+                    while writes and writes[0].done():
+                        yield writes.popleft().result()
+
+                    if exhausted and not (reads or computes or writes):
+                        return
+
+                    # wait for the head which can unblock, a finished head of a full stage can not
+                    heads = []
+                    if reads and len(computes) < self.max_in_flight:
+                        heads.append(reads[0])
+                    if computes and (self.write is None or len(writes) < self.max_pending_writes):
+                        heads.append(computes[0])
+                    if writes:
+                        heads.append(writes[0])
+                    wait(heads, return_when=FIRST_COMPLETED)
+            finally:
+                for future in list(reads) + list(computes) + list(writes):
+                    future.cancel()
@@ -0,0 +1,136 @@
+"""
+prefilter.py
+    [class] FrameFilter: cheap check on the raw temperature matrix before any rgb work
+    [class] SpreadFilter, HotBlobFilter, DownscaledCircleFilter: built-in FrameFilter
+    [class] FilterChain: run the filters in order and count the rejects of each stage
+"""
+import logging
+from collections import Counter
+
+import cv2
+import numpy as np
+
+from .anchor import AnchorDetector
+
+LOGGER = logging.getLogger(__name__)
+# stage name of the frame passed all of the stages
+ACCEPTED = 'accepted'
+
+class FrameFilter(object):
+    """
+    Return True if the frame may qualify, subclass and override check()
+    [Input] name: stage name in the reject counts
+    """
+    def __init__(self, name=None):
+        super().__init__()
+        self.name = name or self.__class__.__name__
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.name)
+
+    def check(self, mat):
+        raise NotImplementedError
+
+class SpreadFilter(FrameFilter):
+    """
+    Reject the frame whose temperature difference is less than min_spread
+    """
+    def __init__(self, min_spread, name='spread'):
+        super().__init__(name)
+        self.min_spread = min_spread
+
+    def __repr__(self):
+        return '{}(min_spread={}, name={})'.format(self.__class__.__name__, self.min_spread, self.name)
+
+    def check(self, mat):
+        return float(mat.max()) - float(mat.min()) >= self.min_spread
+
+class HotBlobFilter(FrameFilter):
+    """
+    Reject the frame with less than min_blobs hot regions
+    the hot region is connected pixels above threshold of at least min_area pixels
+    [Input] threshold: absolute temperature, or relative in 0..1 of the frame range if relative
+    """
+    def __init__(self, min_blobs=4, threshold=0.6, relative=True, min_area=4, name='hot_blob'):
+        super().__init__(name)
+        self.min_blobs = min_blobs
+        self.threshold = threshold
+        self.relative = relative
+        self.min_area = min_area
+
+    def __repr__(self):
+        return '{}(min_blobs={}, threshold={}, relative={}, min_area={}, name={})'.format(
+            self.__class__.__name__, self.min_blobs, self.threshold, self.relative, self.min_area, self.name)
+
+    def check(self, mat):
+        threshold = self.threshold
+        if self.relative:
+            heat_min = float(mat.min())
+            threshold = heat_min + self.threshold * (float(mat.max()) - heat_min)
+        mask = np.greater_equal(mat, threshold).view(np.uint8)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        # label 0 is the background
+        return int(np.count_nonzero(stats[1:, cv2.CC_STAT_AREA] >= self.min_area)) >= self.min_blobs
+
+class DownscaledCircleFilter(FrameFilter):
+    """
+    Reject the frame with less than min_circles Hough circles on the downscaled 8-bit matrix
+    [Input] detector: AnchorDetector for the Hough setting, normalization and downscale
+    """
+    def __init__(self, detector=None, name='downscaled_circle'):
+        super().__init__(name)
+        self.detector = detector or AnchorDetector()
+
+    def __repr__(self):
+        return '{}(detector={}, name={})'.format(self.__class__.__name__, self.detector, self.name)
+
+    def check(self, mat):
+        detector = self.detector
+        small = cv2.resize(detector.to_8bit(mat), None, fx=detector.downscale, fy=detector.downscale,
+                           interpolation=cv2.INTER_AREA)
+        return len(detector.hough(small, scale=detector.downscale)) >= detector.min_circles
+
+class FilterChain(object):
+    """
+    Run the filters in order, the first failed one rejects the frame
+    the workers only return Counter of the stages, the parent records them into counts
+    the converter adds its own stages e.g. 'hough' and ACCEPTED
+
+    [Input] list of FrameFilter
+    """
+    def __init__(self, filters):
+        super().__init__()
+        self.filters = list(filters)
+        self.counts = Counter()
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.filters)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['counts'] = Counter()
+        return state
+
+    def check(self, mat):
+        """
+        [Output] name of the rejecting stage, None if the frame passed all of the filters
+        """
+        for frame_filter in self.filters:
+            if not frame_filter.check(mat):
+                return frame_filter.name
+
+    def record(self, counts):
+        """
+        [Input] Counter of stage name from the worker
+        """
+        self.counts.update(counts)
+
+    def report(self):
+        """
+        [Output] (str) number of frames rejected by each stage
+        """
+        names = [f.name for f in self.filters]
+        names += sorted(k for k in self.counts if k not in names and k != ACCEPTED)
+        return 'checked={} accepted={} rejected: {}'.format(
+            sum(self.counts.values()), self.counts[ACCEPTED],
+            ', '.join('{}={}'.format(name, self.counts[name]) for name in names))
@@ -0,0 +1,119 @@
+"""
+projection.py
+    [class] TemporalProjection: streaming per-pixel max, min, mean and std across the frames of a recording
+"""
+import logging
+
+import numpy as np
+
+from .heatmap import HeatMap
+
+LOGGER = logging.getLogger(__name__)
+PROJECTIONS = ('max', 'min', 'mean', 'std')
+
+class TemporalProjection(object):
+    """
+    Per-pixel statistics over time by Welford's update, one frame at a time in float64
+    memory is a few maps of the frame size no matter how many frames
+    the projections of the chunks are merged by Chan's formula, so the workers reduce in parallel
+
+    [Input] shape: (H, W) of the frame, None to take from the first frame
+    """
+    def __init__(self, shape=None):
+        super().__init__()
+        self.count = 0
+        self.shape = tuple(shape) if shape is not None else None
+        self._mean = None
+        self._m2 = None
+        self._max = None
+        self._min = None
+
+    def __repr__(self):
+        return '{}(shape={}, count={})'.format(self.__class__.__name__, self.shape, self.count)
+
+    def _init_maps(self, shape):
+        self.shape = tuple(shape)
+        self._mean = np.zeros(self.shape, dtype=np.float64)
+        self._m2 = np.zeros(self.shape, dtype=np.float64)
+        self._max = np.full(self.shape, -np.inf, dtype=np.float64)
+        self._min = np.full(self.shape, np.inf, dtype=np.float64)
+
+    def update(self, mat):
+        """
+        [Input] (ndarray) temperature matrix of the next frame
+        """
+        if self._mean is None:
+            self._init_maps(mat.shape)
+        elif mat.shape != self.shape:
+            raise ValueError('expect frame shape {} but got {}'.format(self.shape, mat.shape))
+
+        mat = np.asarray(mat, dtype=np.float64)
+        self.count += 1
+        delta = mat - self._mean
+        self._mean += delta / self.count
+        # m2 += (x - old mean) * (x - new mean)
+        delta *= mat - self._mean
+        self._m2 += delta
+        np.maximum(self._max, mat, out=self._max)
+        np.minimum(self._min, mat, out=self._min)
+        return self
+
+    def merge(self, other):
+        """
+        [Input] TemporalProjection of another chunk of the same recording
+        """
+        if not other.count:
+            return self
+        if not self.count:
+            self._init_maps(other.shape)
+        elif other.shape != self.shape:
+            raise ValueError('expect frame shape {} but got {}'.format(self.shape, other.shape))
+
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        self._m2 += other._m2 + delta**2 * (self.count * other.count / count)
+        self._mean += delta * (other.count / count)
+        self.count = count
+        np.maximum(self._max, other._max, out=self._max)
+        np.minimum(self._min, other._min, out=self._min)
+        return self
+
+    @property
+    def max(self):
+        return self._max
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def std(self):
+        """population standard deviation, the same as np.std(stack, axis=0)"""
+        if not self.count:
+            return None
+        return np.sqrt(self._m2 / self.count)
+
+    def projection(self, name):
+        """
+        [Input] one of PROJECTIONS
+        [Output] (ndarray) float64 map in shape (H, W)
+        """
+        if name not in PROJECTIONS:
+            raise ValueError('projection should be one of {}, got {}'.format(PROJECTIONS, name))
+        if not self.count:
+            raise ValueError('no frame is projected')
+        return getattr(self, name)
+
+    def to_heatmap(self, name, colormap='temperature', normalization=None):
+        """
+        [Input] name: one of PROJECTIONS, normalization: Normalization, default to the range of the map
+                the fixed range is in temperature and not applied to std
+        [Output] HeatMap of the projection, render by transform_to_rgb() or transform_to_gray()
+        """
+        if name == 'std':
+            normalization = None
+        return HeatMap(self.projection(name), colormap=colormap, normalization=normalization)
@@ -0,0 +1,83 @@
+"""
+reader.py
+    [class] ThermaCAMReader: parse ThermaCAM .txt matrix into ndarray at once
+"""
+import logging
+
+import numpy as np
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+FRAME_SHAPE = (240, 320)
+
+# numpy>=1.23 parse loadtxt in C which is faster than fromstring,
+# older numpy parse loadtxt in pure python line by line
+_C_LOADTXT = tuple(int(v) for v in np.__version__.split('.')[:2]) >= (1, 23)
+
+class ThermaCAMReader(object):
+    """
+    Read the whole ThermaCAM comma-separated matrix file in one buffer
+
+    [Input]
+        shape: (row, col) of the frame, None to detect from the file
+        header_rows: number of leading lines to skip
+        dtype: dtype of the output matrix
+    [Output] ndarray
+    """
+    def __init__(self, shape=FRAME_SHAPE, header_rows=0, dtype=np.float32):
+        super().__init__()
+        self.shape = tuple(shape) if shape is not None else None
+        self.header_rows = header_rows
+        self.dtype = np.dtype(dtype)
+
+    def __repr__(self):
+        return '{}(shape={}, header_rows={}, dtype={})'.format(
+            self.__class__.__name__, self.shape, self.header_rows, self.dtype.name)
+
+    def _split_lines(self, text):
+        """drop the header, empty lines and the trailing comma of each line"""
+        lines = text.splitlines()[self.header_rows:]
+        return [line.rstrip(', \t') for line in lines if line.strip(', \t')]
+
+    def _frame_shape(self, file_path, row, size):
+        if not row or size % row:
+            raise ValueError('{}: cannot arrange {} values in {} rows'.format(file_path, size, row))
+        shape = (row, size // row)
+        if self.shape is not None and shape != self.shape:
+            raise ValueError('{}: expect shape {} but got {}'.format(file_path, self.shape, shape))
+        return shape
+
+    def parse(self, data, out=None, file_path='<buffer>'):
+        """
+        [Input] (bytes/str) whole content of the file
+                out: ndarray to copy the matrix into e.g. a slice of a stack, not zero-copy,
+                     the text parser always allocates its own result first
+        [Output] (ndarray) matrix in self.shape, out if given
+        """
+        with metrics.timer('parse'):
+            if isinstance(data, bytes):
+                data = data.decode('ascii')
+            lines = self._split_lines(data)
+
+            if _C_LOADTXT:
+                mat = np.loadtxt(lines, delimiter=',', dtype=self.dtype, ndmin=2)
+            else:
+                mat = np.fromstring(','.join(lines), dtype=self.dtype, sep=',')
+
+        shape = self._frame_shape(file_path, len(lines), mat.size)
+        if out is None:
+            return mat.reshape(shape)
+        out[...] = mat.reshape(shape)
+        return out
+
+    def read(self, file_path, out=None):
+        """
+        [Input] file path, out: ndarray to copy the matrix into, see parse()
+        [Output] (ndarray) matrix in self.shape, out if given
+        """
+        with metrics.timer('read'), open(file_path, 'rb') as f:
+            data = f.read()
+        return self.parse(data, out=out, file_path=file_path)
+
+DEFAULT_READER = ThermaCAMReader()
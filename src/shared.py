@@ -0,0 +1,168 @@
+"""
+shared.py
+    [class] SharedArray: ndarray of the collected shared memory, keep the segment mapped while referenced
+    [class] SharedFrameBuffer: (N, ...) output array written by the workers in place
+"""
+import logging
+import os
+import uuid
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+from os.path import abspath
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+# the buffer the worker attached last, closed as soon as the worker attaches another buffer
+_ATTACHED = {}
+# the shared memory created in this process, a forked worker inherits the mapping but only attaches by name
+_CREATED = weakref.WeakSet()
+
+def _release_created():
+    """
+    Unmap the shared memory of the parent in the forked worker, the parent keeps its own mapping
+    """
+    for buffer in list(_CREATED):
+        buffer._array = None
+        try:
+            buffer._shm.close()
+        except (AttributeError, BufferError):
+            # collected already, or a view is still held by the frame of the parent
+            pass
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_release_created)
+
+class SharedArray(np.ndarray):
+    """
+    Result of SharedFrameBuffer.collect() without copy
+    the segment is already unlinked, its memory is freed once the array and its views are released
+    and no process worker still maps it: a worker keeps the buffer of its last job attached
+    until it attaches the buffer of the next job or exits, so at most one stale segment per worker,
+    plus the collected arrays alive when the worker was forked
+    """
+    _shm = None
+
+class SharedFrameBuffer(object):
+    """
+    Output array the workers write the converted frame into directly
+    only the frame index goes back to the parent instead of the pickled image
+
+    backed by multiprocessing.shared_memory, or a .npy memmap if path is given
+    pickle by name only, the worker writes through attach(), attached once per job in each process
+
+    [Input] shape: (N, H, W) or (N, H, W, 3), dtype, path: .npy path of the memmap
+    """
+    def __init__(self, shape, dtype=np.uint8, path=None, name=None, token=None):
+        super().__init__()
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.path = abspath(path) if path is not None else None
+        self.name = name
+        # tell apart the memmaps created at the same path
+        self.token = token
+        self._shm = None
+        self._array = None
+
+    def __repr__(self):
+        return '{}(shape={}, dtype={}, path={}, name={})'.format(
+            self.__class__.__name__, self.shape, self.dtype.name, self.path, self.name)
+
+    def __reduce__(self):
+        return (SharedFrameBuffer, (self.shape, self.dtype.str, self.path, self.name, self.token))
+
+    @property
+    def key(self):
+        return (self.path, self.token) if self.path is not None else self.name
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @staticmethod
+    def create(shape, dtype=np.uint8, path=None):
+        """
+        Allocate the buffer in the parent
+        """
+        if path is not None:
+            buffer = SharedFrameBuffer(shape, dtype, path, token=uuid.uuid4().hex)
+            buffer._array = np.lib.format.open_memmap(buffer.path, mode='w+', dtype=dtype, shape=shape)
+            return buffer
+
+        buffer = SharedFrameBuffer(shape, dtype)
+        buffer._shm = SharedMemory(create=True, size=max(buffer.nbytes, 1))
+        buffer.name = buffer._shm.name
+        buffer._array = np.ndarray(buffer.shape, dtype=buffer.dtype, buffer=buffer._shm.buf)
+        _CREATED.add(buffer)
+        return buffer
+
+    def attach(self):
+        """
+        Handle to the buffer created by the parent, opened once per process for the running job
+        the workers share the resource tracker of the parent, so the parent still owns the segment
+        only the last buffer is kept, attaching another one closes it, never close it after writing
+        [Output] SharedFrameBuffer
+        """
+        if self._array is not None:
+            # the same process as create(), serial or thread backend
+            return self
+        handle = _ATTACHED.get(self.key)
+        if handle is not None:
+            return handle
+        # the previous job is over, release its segment in this worker
+        for stale in _ATTACHED.values():
+            stale.close()
+        _ATTACHED.clear()
+
+        handle = SharedFrameBuffer(self.shape, self.dtype, self.path, self.name, self.token)
+        if handle.path is not None:
+            handle._array = np.lib.format.open_memmap(handle.path, mode='r+')
+        else:
+            handle._shm = SharedMemory(name=handle.name)
+            handle._array = np.ndarray(handle.shape, dtype=handle.dtype, buffer=handle._shm.buf)
+        _ATTACHED[self.key] = handle
+        return handle
+
+    @property
+    def array(self):
+        return self._array
+
+    def close(self):
+        """
+        Release the handle in this process
+        """
+        if isinstance(self._array, np.memmap):
+            self._array.flush()
+        self._array = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def unlink(self):
+        """
+        Free the shared memory, call it once in the parent
+        """
+        shm = self._shm
+        self._shm = None
+        self.close()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def collect(self):
+        """
+        Hand the result over in the parent without copy
+        the name of the shared memory is unlinked at once, the mapping lives as long as the array
+        [Output] (SharedArray) backed by the shared memory, or the read-only memmap if path is given
+        """
+        if self.path is not None:
+            self.close()
+            return np.load(self.path, mmap_mode='r')
+
+        array = self._array.view(SharedArray)
+        # the array holds the handle so the mapping is closed only after the array is released
+        array._shm = self._shm
+        self._shm.unlink()
+        self._shm = None
+        self._array = None
+        return array
@@ -0,0 +1,454 @@
+"""
+sink.py
+    [class] ReorderBuffer: hold the results completed out of order until the next one in sequence
+    [class] FrameSink: output of the converted frames in the order of recording, instead of cb_save
+    [class] VideoSink: stream the frames into one video file by cv2.VideoWriter
+    [class] NpyStackSink: append the frames in chunks to one (N, H, W[, 3]) uint8 .npy with .json index
+    [class] TarShardSink: encoded images in size-bounded tar shards with .json index of the byte offsets
+"""
+import io
+import json
+import logging
+import os
+import tarfile
+from ast import literal_eval
+from os.path import abspath, basename, dirname, exists, join, splitext
+
+import cv2
+import numpy as np
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+class ReorderBuffer(object):
+    """
+    Release the items in the order of their sequence number
+    at most capacity items wait for an earlier one, the producer should not run further ahead
+
+    [Input] capacity: max number of items held, start: first sequence number
+    """
+    def __init__(self, capacity, start=0):
+        super().__init__()
+        self.capacity = capacity
+        self.next_index = start
+        self._pending = {}
+
+    def __repr__(self):
+        return '{}(capacity={}, next_index={}, pending={})'.format(
+            self.__class__.__name__, self.capacity, self.next_index, len(self._pending))
+
+    def __len__(self):
+        return len(self._pending)
+
+    def push(self, index, item):
+        """
+        [Input] sequence number and item
+        [Output] (list) items ready in order, empty if an earlier one is still missing
+        """
+        if index < self.next_index or index in self._pending:
+            raise ValueError('sequence number {} is already pushed'.format(index))
+        if len(self._pending) >= self.capacity and index != self.next_index:
+            raise OverflowError('{} is full, waiting for {}'.format(self, self.next_index))
+        self._pending[index] = item
+
+        ready = []
+        while self.next_index in self._pending:
+            ready.append(self._pending.pop(self.next_index))
+            self.next_index += 1
+        return ready
+
+def write_index(index_path, index):
+    """write the .json index into a temp file then rename"""
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+
+class FrameSink(object):
+    """
+    Receive the converted frames one by one in the order of recording, subclass and override
+    write() and close(), see ConcurrentConverter.cf_file_to_sink
+    the sink lives in the parent, the workers only convert
+    encoding: image extension e.g. '.png' to have the workers encode and write() get the bytes,
+              the rgb frames are encoded from BGR as cv2.imencode expects
+    """
+    encoding = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, path, image):
+        """
+        [Input] source path and uint8 image in shape (H, W, 3) of RGB or (H, W)
+        """
+        raise NotImplementedError
+
+    def written_paths(self):
+        """
+        [Output] (set) source paths already in the output, skipped by cf_file_to_sink when appending
+        """
+        return set()
+
+    def close(self):
+        """flush and finalize the output"""
+        raise NotImplementedError
+
+    def abort(self):
+        """drop the partial output, default to close"""
+        self.close()
+
+class VideoSink(FrameSink):
+    """
+    Encode the frames in order into one video, written into a temp file and renamed on close
+    so a partial video never shows up at out_path
+    the frame size and color are taken from the first frame, every frame should be the same
+    the rgb frames are converted to BGR as cv2.VideoWriter expects, so the video has the colormap colors
+
+    [Input]
+        out_path: e.g. recording.mp4 or recording.avi
+        fps: frames per second of the video
+        codec: FourCC e.g. 'mp4v', 'MJPG', 'XVID', 'FFV1' (lossless)
+    """
+    def __init__(self, out_path, fps=30.0, codec='mp4v'):
+        super().__init__()
+        if len(codec) != 4:
+            raise ValueError('codec should be FourCC of 4 characters, got {}'.format(codec))
+        self.out_path = out_path
+        self.fps = fps
+        self.codec = codec
+        root, ext = splitext(out_path)
+        self.temp_path = '{}.{}.tmp{}'.format(root, os.getpid(), ext)
+        self.count = 0
+        self._writer = None
+        self._shape = None
+
+    def __repr__(self):
+        return '{}(out_path={}, fps={}, codec={}, count={})'.format(
+            self.__class__.__name__, self.out_path, self.fps, self.codec, self.count)
+
+    def _open(self, image):
+        self._shape = image.shape
+        if dirname(self.out_path):
+            os.makedirs(dirname(self.out_path), exist_ok=True)
+        height, width = image.shape[:2]
+        self._writer = cv2.VideoWriter(self.temp_path, cv2.VideoWriter_fourcc(*self.codec), self.fps,
+                                       (width, height), image.ndim == 3)
+        if not self._writer.isOpened():
+            self._writer = None
+            raise IOError('cannot open video writer of {} for {}'.format(self.codec, self.out_path))
+
+    def write(self, path, image):
+        if self._writer is None:
+            self._open(image)
+        elif image.shape != self._shape:
+            raise ValueError('{}: expect frame shape {} but got {}'.format(path, self._shape, image.shape))
+        with metrics.timer('encode_video'):
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            self._writer.write(image)
+        self.count += 1
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.release()
+        self._writer = None
+        os.replace(self.temp_path, self.out_path)
+        LOGGER.info('Saved {} frames in {}'.format(self.count, self.out_path))
+
+    def abort(self):
+        if self._writer is None:
+            return
+        self._writer.release()
+        self._writer = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class NpyStackSink(FrameSink):
+    """
+    One (N, H, W, 3) or (N, H, W) uint8 .npy, the frames are buffered and appended chunk by chunk
+    so the folder becomes a few large sequential writes, frame k is at a fixed offset
+    the frames are stored as written, RGB or gray, no channel swap
+    the header is rewritten with the frame count after each chunk, the sidecar .json index keeps
+    the source path of each frame, load with NpyStackSink.open_stack()
+    the paths of each chunk are appended to a .jsonl journal and merged into the .json on close,
+    so a killed job resumes with append=True from the frames both written and indexed,
+    cf_file_to_sink converts only the paths not in the stack yet
+
+    [Input]
+        out_path: .npy path
+        chunk_frames: number of frames per write
+        append: continue an existing stack of the same frame shape
+    """
+    # fixed header size so the frame count can be rewritten in place
+    HEADER_SIZE = 128
+
+    def __init__(self, out_path, chunk_frames=64, append=False):
+        super().__init__()
+        self.out_path = abspath(out_path)
+        self.index_path = splitext(self.out_path)[0] + '.json'
+        self.journal_path = splitext(self.out_path)[0] + '.jsonl'
+        self.chunk_frames = chunk_frames
+        self.paths = []
+        self.count = 0
+        self._file = None
+        self._frame_shape = None
+        self._chunk = None
+        self._chunk_len = 0
+        if append and exists(self.out_path):
+            self._reopen()
+
+    def __repr__(self):
+        return '{}(out_path={}, chunk_frames={}, count={})'.format(
+            self.__class__.__name__, self.out_path, self.chunk_frames, self.count)
+
+    @staticmethod
+    def _header(shape):
+        header = "{{'descr': '|u1', 'fortran_order': False, 'shape': {}, }}".format(tuple(shape))
+        size = NpyStackSink.HEADER_SIZE - 10
+        if len(header) >= size:
+            raise ValueError('shape {} does not fit in the header'.format(shape))
+        # magic, version 1.0, header length and the dict padded with spaces to end with newline
+        return b'\x93NUMPY\x01\x00' + size.to_bytes(2, 'little') + header.ljust(size-1).encode('latin1') + b'\n'
+
+    def _reopen(self):
+        with open(self.out_path, 'rb') as f:
+            f.seek(10)
+            header = literal_eval(f.read(self.HEADER_SIZE-10).decode('latin1'))
+        self.paths = self._load_paths(self.index_path, self.journal_path)
+        # an interrupted job may have frames written but not indexed, keep the indexed ones
+        self.count = min(header['shape'][0], len(self.paths))
+        self.paths = self.paths[:self.count]
+        self._frame_shape = tuple(header['shape'][1:])
+        self._file = open(self.out_path, 'r+b')
+        self._file.truncate(self.HEADER_SIZE + self.count * int(np.prod(self._frame_shape)))
+        self._file.write(self._header((self.count,) + self._frame_shape))
+        self._file.seek(0, os.SEEK_END)
+        # the journal restarts after the recovered paths
+        self._write_index()
+
+    @staticmethod
+    def _load_paths(index_path, journal_path):
+        """
+        [Output] (list) paths of the .json index followed by the .jsonl journal,
+                 the partial last line of a killed job is dropped
+        """
+        paths = []
+        if exists(index_path):
+            with open(index_path, 'r') as f:
+                paths = json.load(f)['paths']
+        if exists(journal_path):
+            with open(journal_path, 'rb') as f:
+                data = f.read()
+            paths += [json.loads(line.decode('utf-8')) for line in data[:data.rfind(b'\n')+1].splitlines()]
+        return paths
+
+    def written_paths(self):
+        return set(self.paths)
+
+    def _write_index(self):
+        write_index(self.index_path, {'paths': self.paths, 'shape': list(self._frame_shape)})
+        if exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def _open(self, image):
+        if dirname(self.out_path):
+            os.makedirs(dirname(self.out_path), exist_ok=True)
+        self._frame_shape = image.shape
+        self._file = open(self.out_path, 'w+b')
+        self._file.write(self._header((0,) + self._frame_shape))
+        # drop the index of the stack overwritten
+        for path in (self.index_path, self.journal_path):
+            if exists(path):
+                os.remove(path)
+
+    def write(self, path, image):
+        if self._file is None:
+            self._open(image)
+        if image.shape != self._frame_shape:
+            raise ValueError('{}: expect frame shape {} but got {}'.format(path, self._frame_shape, image.shape))
+        if self._chunk is None:
+            self._chunk = np.empty((self.chunk_frames,) + self._frame_shape, dtype=np.uint8)
+        self._chunk[self._chunk_len] = image
+        self._chunk_len += 1
+        self.paths.append(path)
+        if self._chunk_len == self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        """append the buffered frames, update the frame count then journal their paths"""
+        if not self._chunk_len:
+            return
+        with metrics.timer('write_chunk'):
+            self._file.write(self._chunk[:self._chunk_len].tobytes())
+            self._file.seek(0)
+            self._file.write(self._header((self.count + self._chunk_len,) + self._frame_shape))
+            self._file.seek(0, os.SEEK_END)
+            self._file.flush()
+            with open(self.journal_path, 'a') as f:
+                f.writelines(json.dumps(path) + '\n' for path in self.paths[self.count:])
+            self.count += self._chunk_len
+            self._chunk_len = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+        self._write_index()
+        LOGGER.info('Saved {} frames in {}'.format(self.count, self.out_path))
+
+    @staticmethod
+    def open_stack(out_path):
+        """
+        [Output] (read-only memmap of the frames, list of source paths)
+        any frame range is a slice of the memmap
+        """
+        root = splitext(abspath(out_path))[0]
+        paths = NpyStackSink._load_paths(root + '.json', root + '.jsonl')
+        frames = np.load(out_path, mmap_mode='r')
+        return frames[:len(paths)], paths
+
+class TarShardSink(FrameSink):
+    """
+    Encoded images appended to tar shards of at most max_shard_bytes, the workers encode
+    each shard is written as .tmp and renamed once full, the sidecar .json index records
+    the shard, byte offset and size of each frame, so a range of frames is one seek and one read
+    the bound counts the tar headers, padding and end of archive, only a single frame larger
+    than the bound makes a shard exceed it
+    the rgb frames are encoded from BGR, so the images in the shards have the colormap colors,
+    cv2.imread and read_range() give them back in BGR
+
+    [Input]
+        prefix: shards are <prefix>-000000.tar, <prefix>-000001.tar, ... index is <prefix>.json
+        max_shard_bytes: size bound of a shard
+        encoding: '.png' or '.jpg'
+        append: continue after the shards of the existing index, cf_file_to_sink skips the indexed paths
+    """
+    def __init__(self, prefix, max_shard_bytes=256*1024*1024, encoding='.png', append=False):
+        super().__init__()
+        self.prefix = abspath(prefix)
+        self.index_path = self.prefix + '.json'
+        self.max_shard_bytes = max_shard_bytes
+        self.encoding = encoding
+        self.shards = []
+        self.frames = []
+        self._tar = None
+        if append and exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            self.shards, self.frames = index['shards'], index['frames']
+
+    def __repr__(self):
+        return '{}(prefix={}, max_shard_bytes={}, encoding={}, shards={})'.format(
+            self.__class__.__name__, self.prefix, self.max_shard_bytes, self.encoding, len(self.shards))
+
+    @property
+    def count(self):
+        return len(self.frames)
+
+    def written_paths(self):
+        return set(frame[0] for frame in self.frames)
+
+    def _shard_path(self, name):
+        return join(dirname(self.prefix), name)
+
+    @staticmethod
+    def _padded(size):
+        return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    @staticmethod
+    def _closed_size(offset):
+        """size of the shard closed at offset, two zero blocks then zeros up to RECORDSIZE"""
+        return -(-(offset + 2*tarfile.BLOCKSIZE) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+    def _member_name(self, path):
+        """'<frame number>_<stem><ext>' with the stem cut to fit the 100 bytes of the ustar name"""
+        prefix = '{:08d}_'.format(self.count)
+        budget = 100 - len(prefix.encode('utf-8')) - len(self.encoding.encode('utf-8'))
+        stem = splitext(basename(path))[0].encode('utf-8')[:budget].decode('utf-8', 'ignore')
+        return prefix + stem + self.encoding
+
+    def _open_shard(self):
+        name = '{}-{:06d}.tar'.format(basename(self.prefix), len(self.shards))
+        if dirname(self.prefix):
+            os.makedirs(dirname(self.prefix), exist_ok=True)
+        self._tar = tarfile.open(self._shard_path(name) + '.tmp', 'w', format=tarfile.USTAR_FORMAT)
+        self.shards.append(name)
+
+    def _close_shard(self):
+        self._tar.close()
+        self._tar = None
+        name = self.shards[-1]
+        os.replace(self._shard_path(name) + '.tmp', self._shard_path(name))
+        write_index(self.index_path, {'shards': self.shards, 'frames': self.frames})
+
+    def write(self, path, data):
+        """
+        [Input] source path and the encoded image in bytes
+        """
+        member_bytes = tarfile.BLOCKSIZE + self._padded(len(data))
+        if self._tar is not None and self._tar.offset and \
+                self._closed_size(self._tar.offset + member_bytes) > self.max_shard_bytes:
+            self._close_shard()
+        if self._tar is None:
+            self._open_shard()
+
+        member = tarfile.TarInfo(self._member_name(path))
+        member.size = len(data)
+        with metrics.timer('write_tar'):
+            self._tar.addfile(member, io.BytesIO(data))
+        # the data ends at the offset after the member, before its padding
+        offset = self._tar.offset - self._padded(member.size)
+        self.frames.append([path, len(self.shards)-1, offset, member.size])
+
+    def close(self):
+        if self._tar is not None:
+            self._close_shard()
+            LOGGER.info('Saved {} frames in {} shards of {}'.format(self.count, len(self.shards), self.prefix))
+
+    def abort(self):
+        """keep the finished shards, the partial shard is dropped from the index"""
+        if self._tar is None:
+            return
+        self._tar.close()
+        self._tar = None
+        shard = len(self.shards) - 1
+        os.remove(self._shard_path(self.shards.pop()) + '.tmp')
+        self.frames = [frame for frame in self.frames if frame[1] != shard]
+
+    @staticmethod
+    def read_range(prefix, start, stop, flags=cv2.IMREAD_UNCHANGED):
+        """
+        [Input] prefix of the shards, frame range [start, stop)
+        [Output] (list) of (source path, decoded image in BGR as cv2.imdecode)
+        """
+        prefix = abspath(prefix)
+        with open(prefix + '.json', 'r') as f:
+            index = json.load(f)
+
+        frames = index['frames'][start:stop]
+        images = []
+        i = 0
+        while i < len(frames):
+            # consecutive frames of the same shard are one contiguous span
+            j = i
+            while j + 1 < len(frames) and frames[j+1][1] == frames[i][1]:
+                j += 1
+            first, last = frames[i][2], frames[j][2] + frames[j][3]
+            with open(join(dirname(prefix), index['shards'][frames[i][1]]), 'rb') as f:
+                f.seek(first)
+                span = f.read(last - first)
+            for path, _, offset, size in frames[i:j+1]:
+                data = np.frombuffer(span, dtype=np.uint8, count=size, offset=offset - first)
+                images.append((path, cv2.imdecode(data, flags)))
+            i = j + 1
+        return images
@@ -0,0 +1,212 @@
+"""
+stats.py
+    [class] FrameStats: per-frame statistics record
+    [class] FrameStatsIndex: persist per-frame statistics in SQLite next to the data
+"""
+import heapq
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+from os import sep
+from os.path import abspath
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+PERCENTILES = (5, 50, 95)
+
+FrameStats = namedtuple('FrameStats', ['heat_min', 'heat_max', 'mean', 'std', 'p5', 'p50', 'p95'])
+
+def calc_frame_stats(mat):
+    """
+    [Input] (ndarray) temperature matrix
+    [Output] FrameStats
+    """
+    mat = np.asarray(mat, dtype=np.float64)
+    percentiles = np.percentile(mat, PERCENTILES)
+    return FrameStats(
+        float(mat.min()), float(mat.max()), float(mat.mean()), float(mat.std()),
+        *(float(p) for p in percentiles)
+    )
+
+def source_signature(path):
+    """(mtime_ns, size) of the source, (0, 0) if the source is gone e.g. packed"""
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return 0, 0
+
+class FrameStatsIndex(object):
+    """
+    Per-frame min, max, mean, std and percentiles keyed by source path
+    the record is outdated once the source mtime or size changed
+    close the connection when done, or use as a context manager
+
+    [Input] db_path: SQLite file, see FrameStatsIndex.path_of(folder)
+    """
+    COLUMNS = ('path', 'mtime_ns', 'size') + FrameStats._fields
+    # number of paths looked up in one query, below the SQLite limit of host parameters
+    LOOKUP_BATCH = 500
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = abspath(db_path)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS frames ('
+            'path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, '
+            'heat_min REAL, heat_max REAL, mean REAL, std REAL, p5 REAL, p50 REAL, p95 REAL)'
+        )
+        self.conn.commit()
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.db_path)
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM frames').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    @staticmethod
+    def path_of(folder):
+        """the index is saved next to the folder, not inside it"""
+        return abspath(folder).rstrip(sep) + '.stats.sqlite'
+
+    @staticmethod
+    def open_for(folder):
+        return FrameStatsIndex(FrameStatsIndex.path_of(folder))
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, path, stats):
+        self.update_many([(path, stats)])
+
+    def update_many(self, records):
+        """
+        [Input] iterable of (path, FrameStats)
+        """
+        rows = [(abspath(path),) + source_signature(path) + tuple(stats) for path, stats in records]
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO frames VALUES ({})'.format(','.join('?'*len(self.COLUMNS))), rows)
+        self.conn.commit()
+        LOGGER.debug('Update {} records in {}'.format(len(rows), self.db_path))
+
+    def record(self, results, batch_size=256):
+        """
+        Record the stats along with the conversion
+        [Input] iterable of (path, (image, FrameStats))
+        [Output] generator of (path, image)
+        """
+        records = []
+        for path, (image, stats) in results:
+            records.append((path, stats))
+            if len(records) >= batch_size:
+                self.update_many(records)
+                records = []
+            yield path, image
+        self.update_many(records)
+
+    def get(self, path, check_fresh=True):
+        """
+        [Output] FrameStats, None if not indexed or outdated
+        """
+        row = self.conn.execute(
+            'SELECT * FROM frames WHERE path = ?', (abspath(path),)).fetchone()
+        if row is None:
+            return
+        if check_fresh and tuple(row[1:3]) != source_signature(path):
+            return
+        return FrameStats(*row[3:])
+
+    def get_many(self, paths, check_fresh=True):
+        """
+        Batched get, LOOKUP_BATCH paths per query
+        [Output] (list) FrameStats of each path, None if not indexed or outdated
+        """
+        paths = list(paths)
+        rows = {}
+        for i in range(0, len(paths), self.LOOKUP_BATCH):
+            keys = [abspath(path) for path in paths[i:i+self.LOOKUP_BATCH]]
+            rows.update((row[0], row) for row in self.conn.execute(
+                'SELECT * FROM frames WHERE path IN ({})'.format(','.join('?'*len(keys))), keys))
+
+        records = []
+        for path in paths:
+            row = rows.get(abspath(path))
+            if row is None or (check_fresh and tuple(row[1:3]) != source_signature(path)):
+                records.append(None)
+            else:
+                records.append(FrameStats(*row[3:]))
+        return records
+
+    def missing(self, paths, check_fresh=True):
+        """
+        [Output] (list) paths not indexed or outdated
+        """
+        paths = list(paths)
+        return [path for path, stats in zip(paths, self.get_many(paths, check_fresh)) if stats is None]
+
+    def _query(self, paths, where='', params=(), order=''):
+        sql = 'SELECT path FROM frames {} {}'.format(where, order)
+        rows = self.conn.execute(sql, params)
+        if paths is None:
+            return [row[0] for row in rows]
+        wanted = {abspath(path): path for path in paths}
+        return [wanted[row[0]] for row in rows if row[0] in wanted]
+
+    def top_by_temperature_difference(self, k=1, paths=None):
+        """
+        [Input] k, paths: limit to these paths, None means all indexed frames
+        [Output] (list) paths of the top k temperature difference in descending order
+                 the earlier one in paths wins if the temperature difference is the same,
+                 the same rule as Converter.heap_by_temperature_difference, path ASC without paths
+        """
+        if paths is None:
+            return self._query(None, order='ORDER BY heat_max - heat_min DESC, path ASC')[:k]
+
+        paths = list(paths)
+        position = {abspath(path): i for i, path in enumerate(paths)}
+        rows = self.conn.execute('SELECT path, heat_max - heat_min FROM frames')
+        top = heapq.nsmallest(k, ((-diff, position[key]) for key, diff in rows if key in position))
+        return [paths[i] for _, i in top]
+
+    def filter(self, min_difference=None, max_difference=None,
+               min_temperature=None, max_temperature=None, paths=None):
+        """
+        [Output] (list) paths meet all of the given threshold
+        """
+        conditions, params = [], []
+        if min_difference is not None:
+            conditions.append('heat_max - heat_min >= ?')
+            params.append(min_difference)
+        if max_difference is not None:
+            conditions.append('heat_max - heat_min <= ?')
+            params.append(max_difference)
+        if min_temperature is not None:
+            conditions.append('heat_min >= ?')
+            params.append(min_temperature)
+        if max_temperature is not None:
+            conditions.append('heat_max <= ?')
+            params.append(max_temperature)
+
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return self._query(paths, where, params, 'ORDER BY path ASC')
+
+    def summary(self):
+        """
+        [Output] (dict) dataset summary of all indexed frames
+        """
+        row = self.conn.execute(
+            'SELECT COUNT(*), MIN(heat_min), MAX(heat_max), AVG(mean), '
+            'MAX(heat_max - heat_min), AVG(heat_max - heat_min) FROM frames'
+        ).fetchone()
+        keys = ('count', 'heat_min', 'heat_max', 'mean', 'max_difference', 'mean_difference')
+        return dict(zip(keys, row))
@@ -5,17 +5,29 @@ wrapper
         2. convert each frame into heatmap
         3. find one of the target heatmap by XXX
         4. convert the target heatmap and return
+    other keyword arguments of cf_convert_XXX are passed to ConcurrentConverter
+        e.g. executor, worker_save, colormap
+    heat_range: None for per-frame range, (heat_min, heat_max) or 'global' for the dataset-wide range
 """
 import logging
+from contextlib import contextmanager
 from concurrent.futures import ProcessPoolExecutor
-from os import listdir, makedirs, sep
-from os.path import abspath, dirname, exists, join
+from os import listdir, makedirs, scandir, sep
+from os.path import abspath, dirname, exists, isfile, join
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 
+from src.cache import FrameCache
+from src.color import Normalization
 from src.convert import Converter, ConcurrentConverter
+from src.manifest import ConversionManifest
+from src.order import natural_key
+from src.pack import FramePack
+from src.projection import PROJECTIONS
+from src.sink import VideoSink
+from src.stats import FrameStatsIndex
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,13 +38,76 @@ def construct_png_path(path, i, directory):
     new_path = sep.join(new_path)
     return new_path
 
-def cf_convert_to_grayscale(file_path, change_save_path=(-3, 'save')):
+def list_frame_source(file_path):
+    """
+    Return FramePack if file_path is a packed .npy
+    otherwise the list of file paths under the folder
+    """
+    if isfile(file_path) and file_path.endswith('.npy'):
+        return FramePack.open(file_path)
+    return [join(file_path, i) for i in listdir(file_path)]
+
+def iter_frame_source(file_path):
+    """
+    Lazy list_frame_source, yield the file paths while scanning the folder
+    """
+    if isfile(file_path) and file_path.endswith('.npy'):
+        return FramePack.open(file_path)
+    return (entry.path for entry in scandir(file_path))
+
+def frame_reader(cache_dir=None):
+    """
+    Return FrameCache to reuse the parsed matrix if cache_dir is given
+    None means parse the .txt every time
+    """
+    if cache_dir is None:
+        return None
+    return FrameCache(cache_dir)
+
+@contextmanager
+def frame_stats_index(file_path, with_stats=False):
+    """
+    Open FrameStatsIndex saved next to the folder if with_stats, otherwise None
+    the connection is closed on leaving the with block
+    """
+    if not with_stats:
+        yield None
+        return
+    with FrameStatsIndex.open_for(file_path) as stats_index:
+        yield stats_index
+
+def conversion_manifest(frame_paths, cb_save, params, incremental=False):
+    """
+    Return ConversionManifest next to the output directory if incremental
+    the up-to-date frames are skipped and the interrupted job resumes
+    """
+    frame_paths = ConcurrentConverter.frame_source(frame_paths)[0]
+    if not incremental or cb_save is None or not frame_paths:
+        return None
+    save_directory = dirname(cb_save(frame_paths[0]))
+    return ConversionManifest.for_directory(save_directory, params)
+
+def frame_normalization(frame_paths, heat_range=None, reader=None, stats_index=None):
+    """
+    Return Normalization by heat_range
+        None: per-frame range, (heat_min, heat_max): fixed range e.g. (20, 40)
+        'global': dataset-wide range computed once
+    """
+    if heat_range is None:
+        return None
+    if heat_range == 'global':
+        return ConcurrentConverter.cf_temperature_range(frame_paths, reader, stats_index=stats_index)
+    return Normalization(*heat_range)
+
+def cf_convert_to_grayscale(file_path, change_save_path=(-3, 'save'), cache_dir=None, with_stats=False,
+                            incremental=False, heat_range=None, **kwargs):
     """
     Input file path, there's multiple files under the folder
     convert all of matrix to grayscale image
     """
-    frame_paths = [join(file_path, i) for i in listdir(file_path)]
+    frame_paths = list_frame_source(file_path)
     args = None
+    cb = None
 
     # handle saving path
     if change_save_path is not None and isinstance(change_save_path, tuple):
@@ -43,18 +118,29 @@ def cf_convert_to_grayscale(file_path, change_save_path=(-3, 'save')):
         cb = lambda x: construct_png_path(x, change_save_path[0], change_save_path[1])
         args = (frame_paths, cb)
     else:
-        args = (frame_paths)
+        args = (frame_paths,)
 
-    cf_converter = ConcurrentConverter.cf_file_to_grayscale(*args)
+    reader = frame_reader(cache_dir)
+    with frame_stats_index(file_path, with_stats) as stats_index:
+        normalization = frame_normalization(frame_paths, heat_range, reader, stats_index)
+        params = {'mode': 'gray', 'normalization': repr(normalization), 'reader': repr(reader)}
+        cf_converter = ConcurrentConverter.cf_file_to_grayscale(
+            *args, reader=reader, stats_index=stats_index, normalization=normalization,
+            manifest=conversion_manifest(frame_paths, cb, params, incremental), **kwargs)
     return cf_converter
 
-def cf_convert_by_hough_circle(file_path, draw_circle=False, change_save_path=(-2, 'save')):
+def cf_convert_by_hough_circle(file_path, draw_circle=False, change_save_path=(-2, 'save'), cache_dir=None,
+                               incremental=False, **kwargs):
     """
     Input file path, there's multiple files under the folder
     convert all file into RGB images by hough circles
+    the frames are sorted by file name, so the detector tracks the anchors in the order of recording
     """
-    frame_paths = [join(file_path, i) for i in listdir(file_path)]
+    frame_paths = list_frame_source(file_path)
+    if not isinstance(frame_paths, FramePack):
+        frame_paths = sorted(frame_paths, key=natural_key)
     args = None
+    cb = None
 
     # handle saving path
     if change_save_path is not None and isinstance(change_save_path, tuple):
@@ -67,16 +153,22 @@ def cf_convert_by_hough_circle(file_path, draw_circle=False, change_save_path=(-
     else:
         args = (frame_paths, draw_circle)
 
-    cf_converter = ConcurrentConverter.cf_file_to_rgb_by_hough_circle(*args)
+    reader = frame_reader(cache_dir)
+    params = {'mode': 'hough', 'draw_circle': draw_circle, 'detector': repr(kwargs.get('detector')),
+              'prefilter': repr(kwargs.get('prefilter')), 'reader': repr(reader)}
+    cf_converter = ConcurrentConverter.cf_file_to_rgb_by_hough_circle(
+        *args, reader=reader, manifest=conversion_manifest(frame_paths, cb, params, incremental), **kwargs)
     return cf_converter
 
-def cf_convert_by_max_temperature_difference(file_path, change_save_path=(-3, 'save')):
+def cf_convert_by_max_temperature_difference(file_path, change_save_path=(-3, 'save'), cache_dir=None,
+                                             with_stats=False, **kwargs):
     """
     Input file path, there's multiple files under the folder
     get one of the max temperature difference matrix and convert to RGB image
     """
-    frame_paths = [join(file_path, i) for i in listdir(file_path)]
+    frame_paths = list_frame_source(file_path)
     args = None
+    cb = None
 
     # handle saving path
     if change_save_path is not None and isinstance(change_save_path, tuple):
@@ -87,15 +179,19 @@ def cf_convert_by_max_temperature_difference(file_path, change_save_path=(-3, 's
         cb = lambda x: construct_png_path(x, change_save_path[0], change_save_path[1])
         args = (frame_paths, cb)
     else:
-        args = (frame_paths)
+        args = (frame_paths,)
 
-    cf_converter = ConcurrentConverter.cf_file_to_rgb_by_temperature_difference(*args)
+    with frame_stats_index(file_path, with_stats) as stats_index:
+        cf_converter = ConcurrentConverter.cf_file_to_rgb_by_temperature_difference(
+            *args, reader=frame_reader(cache_dir), stats_index=stats_index, **kwargs)
     return cf_converter
 
-def cf_convert_to_rgb(file_path, change_save_path=(-2, 'save')):
+def cf_convert_to_rgb(file_path, change_save_path=(-2, 'save'), cache_dir=None, with_stats=False,
+                      incremental=False, heat_range=None, **kwargs):
     # cf_convert_by_hough_circle(file_path, False, change_save_path)
-    frame_paths = [join(file_path, i) for i in listdir(file_path)]
+    frame_paths = list_frame_source(file_path)
     args = None
+    cb = None
 
     # handle saving path
     if change_save_path is not None and isinstance(change_save_path, tuple):
@@ -106,7 +202,132 @@ def cf_convert_to_rgb(file_path, change_save_path=(-2, 'save')):
         cb = lambda x: construct_png_path(x, change_save_path[0], change_save_path[1])
         args = (frame_paths, cb)
     else:
-        args = (frame_paths)
+        args = (frame_paths,)
 
-    cf_converter = ConcurrentConverter.cf_file_to_rgb(*args)
+    reader = frame_reader(cache_dir)
+    with frame_stats_index(file_path, with_stats) as stats_index:
+        normalization = frame_normalization(frame_paths, heat_range, reader, stats_index)
+        params = {'mode': 'rgb', 'colormap': kwargs.get('colormap'), 'normalization': repr(normalization),
+                  'reader': repr(reader)}
+        cf_converter = ConcurrentConverter.cf_file_to_rgb(
+            *args, reader=reader, stats_index=stats_index, normalization=normalization,
+            manifest=conversion_manifest(frame_paths, cb, params, incremental), **kwargs)
     return cf_converter
+
+def cf_convert_to_array(file_path, mode='rgb', out_path=None, cache_dir=None, heat_range=None, **kwargs):
+    """
+    Input file path, there's multiple files under the folder
+    convert all of matrix into one (N, H, W, 3) rgb or (N, H, W) gray array in memory
+    or into the .npy memmap if out_path is given
+    """
+    frame_paths = list_frame_source(file_path)
+    reader = frame_reader(cache_dir)
+    cf_converter = ConcurrentConverter.cf_file_to_array(
+        frame_paths, mode, out_path, reader=reader,
+        normalization=frame_normalization(frame_paths, heat_range, reader), **kwargs)
+    return cf_converter
+
+def cf_iter_convert(file_path, mode='rgb', change_save_path=None, cache_dir=None, heat_range=None,
+                    incremental=False, **kwargs):
+    """
+    Input file path, there's multiple files under the folder
+    convert lazily with bounded in-flight tasks, peak memory does not depend on the folder size
+    yield (path, image) if change_save_path is None, otherwise save and yield FrameStatus
+    'global' heat_range scans the folder once more before converting
+    """
+    reader = frame_reader(cache_dir)
+    normalization = frame_normalization(list_frame_source(file_path), heat_range, reader) \
+        if heat_range == 'global' else frame_normalization(None, heat_range)
+
+    if change_save_path is None:
+        return ConcurrentConverter.cf_iter_images(
+            iter_frame_source(file_path), mode, reader=reader, normalization=normalization, **kwargs)
+
+    cb = lambda x: construct_png_path(x, change_save_path[0], change_save_path[1])
+    manifest = None
+    if incremental:
+        first_path = next(iter(ConcurrentConverter.frame_source(iter_frame_source(file_path))[0]), None)
+        params = {'mode': mode, 'normalization': repr(normalization), 'reader': repr(reader)}
+        if mode != 'gray':
+            params['colormap'] = kwargs.get('colormap')
+        manifest = conversion_manifest([first_path] if first_path else [], cb, params, incremental)
+    return ConcurrentConverter.cf_iter_pipeline(
+        iter_frame_source(file_path), mode, cb, reader=reader, normalization=normalization,
+        manifest=manifest, **kwargs)
+
+def cf_convert_to_outputs(file_path, outputs=('rgb', 'gray', 'stats'), change_save_paths=None, cache_dir=None,
+                          with_stats=False, heat_range=None, **kwargs):
+    """
+    Input file path, there's multiple files under the folder
+    read and parse each matrix once for all of the outputs, see ConcurrentConverter.cf_file_to_outputs
+    change_save_paths: dict of 'rgb' or 'gray' to (index, directory) as change_save_path
+                       e.g. {'rgb': (-2, 'save_rgb'), 'gray': (-2, 'save_gray')}
+    with_stats: record the stats output into FrameStatsIndex next to the folder
+    the frames are sorted by file name, so the anchors output is tracked in the order of recording
+    """
+    frame_paths = list_frame_source(file_path)
+    if not isinstance(frame_paths, FramePack):
+        frame_paths = sorted(frame_paths, key=natural_key)
+    cb_saves = {}
+    for output, change_save_path in (change_save_paths or {}).items():
+        cb_saves[output] = lambda x, c=change_save_path: construct_png_path(x, c[0], c[1])
+
+    reader = frame_reader(cache_dir)
+    with frame_stats_index(file_path, with_stats) as stats_index:
+        normalization = frame_normalization(frame_paths, heat_range, reader, stats_index)
+        return list(ConcurrentConverter.cf_file_to_outputs(
+            frame_paths, outputs, cb_saves, reader=reader, stats_index=stats_index,
+            normalization=normalization, **kwargs))
+
+def cf_convert_to_sink(file_path, sink, mode='rgb', cache_dir=None, heat_range=None, **kwargs):
+    """
+    Input file path, there's multiple files under the folder
+    convert all of matrix in the order of file name into the FrameSink e.g. NpyStackSink, TarShardSink
+    the sink is closed when done, return the number of frames written
+    """
+    frame_paths = list_frame_source(file_path)
+    if not isinstance(frame_paths, FramePack):
+        frame_paths = sorted(frame_paths, key=natural_key)
+    reader = frame_reader(cache_dir)
+    normalization = frame_normalization(frame_paths, heat_range, reader)
+    with sink:
+        return ConcurrentConverter.cf_file_to_sink(
+            frame_paths, sink, mode, reader=reader, normalization=normalization, **kwargs)
+
+def cf_convert_to_video(file_path, out_path, mode='rgb', fps=30.0, codec='mp4v', **kwargs):
+    """
+    Input file path, there's multiple files under the folder
+    stream all of matrix in the order of file name into one video instead of one png per frame
+    """
+    return cf_convert_to_sink(file_path, VideoSink(out_path, fps, codec), mode, **kwargs)
+
+def cf_convert_to_projection(file_path, change_save_path=(-2, 'save'), projections=PROJECTIONS, cache_dir=None,
+                             colormap=None, heat_range=None, **kwargs):
+    """
+    Input file path, there's multiple files under the folder
+    stream all of matrix into per-pixel max, min, mean and std maps, render each by the palette
+    and save as projection_<name>.png by change_save_path, None to only return
+    heat_range: (heat_min, heat_max) or 'global' for the whole recording shared by max, min and mean,
+                default to the range of each map
+    return dict of projection name to rgb image
+    """
+    reader = frame_reader(cache_dir)
+    frame_paths = list_frame_source(file_path)
+    projection = ConcurrentConverter.cf_temporal_projection(frame_paths, reader, **kwargs)
+    # the maps take the place of the frames in the folder, or next to the packed .npy
+    folder = dirname(file_path) if isinstance(frame_paths, FramePack) else file_path
+    normalization = frame_normalization(None, heat_range) if heat_range != 'global' else \
+        Normalization(float(projection.min.min()), float(projection.max.max()))
+
+    images = {}
+    for name in projections:
+        rgb = projection.to_heatmap(name, colormap or 'temperature', normalization).transform_to_rgb()
+        images[name] = rgb
+        if change_save_path is not None:
+            saved_path = construct_png_path(
+                join(folder, 'projection_{}.txt'.format(name)), change_save_path[0], change_save_path[1])
+            if not exists(dirname(saved_path)):
+                makedirs(dirname(saved_path))
+            Converter.write_image(saved_path, cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+            LOGGER.info('Saved final result in {}'.format(saved_path))
+    return images